@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Micro-benchmarks of the power command hot path: building the PUT payload and reading the state out of a
+# device response, the former way (JSON per call) against the precomputed payloads and the fast field reader.
+#
+#     python benchmarks/bench_codec.py --number 200000
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from octoprint_ikea_tradfri.registry import DeviceRecord  # noqa: E402
+from octoprint_ikea_tradfri.state import extract_state, read_state  # noqa: E402
+
+OUTLET = json.dumps({
+    "9001": "Printer", "9002": 1550000000, "9020": 1560000000, "9003": 65536, "9054": 0, "9019": 1, "5750": 3,
+    "3": {"0": "IKEA of Sweden", "1": "TRADFRI control outlet", "2": "", "3": "2.3.008", "6": 1},
+    "3312": [{"5850": 1, "5851": 254, "9003": 0}]
+}).encode()
+
+LIGHT = json.dumps({
+    "9001": "Enclosure", "9002": 1550000000, "9020": 1560000000, "9003": 65537, "9054": 0, "9019": 1, "5750": 2,
+    "3": {"0": "IKEA of Sweden", "1": "TRADFRI bulb E27 WS opal 980lm", "2": "", "3": "2.3.050", "6": 1},
+    "3311": [{"5850": 1, "5851": 203, "5706": "f5faf6", "5707": 0, "5708": 0, "5709": 24930, "5710": 24694,
+              "5711": 250, "9003": 0}]
+}).encode()
+
+
+def compare(name, before, after, number):
+    before = min(timeit.repeat(before, number=number, repeat=3)) / number
+    after = min(timeit.repeat(after, number=number, repeat=3)) / number
+    print('{:<24} {:>10.0f} {:>10.0f} {:>9.1f}x'.format(name, before * 1e9, after * 1e9, before / after))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    outlet = DeviceRecord(dict(id=65536, type='Outlet'))
+    light = DeviceRecord(dict(id=65537, type='Light'))
+    assert read_state('3312', OUTLET) == extract_state('3312', json.loads(OUTLET))
+    assert read_state('3311', LIGHT) == extract_state('3311', json.loads(LIGHT))
+
+    print('{:<24} {:>10} {:>10} {:>10}'.format('operation', 'before ns', 'after ns', 'speedup'))
+    compare('PUT payload (str)', lambda: '{ "3312": [{ "5850": 1 }] }'.encode(), lambda: outlet.payloads[1],
+            args.number)
+    compare('PUT payload (dict)', lambda: json.dumps({"3311": [{"5850": 1}]}).encode(), lambda: light.payloads[1],
+            args.number)
+    compare('outlet state', lambda: extract_state('3312', json.loads(OUTLET)), lambda: outlet.decode_state(OUTLET),
+            args.number)
+    compare('light state', lambda: extract_state('3311', json.loads(LIGHT)), lambda: light.decode_state(LIGHT),
+            args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Measure loadDevices against a gateway stand-in with per-request latency, sequentially and with the
+# configured number of in-flight requests.
+#
+#     python benchmarks/bench_discovery.py --devices 40 --latency 0.05 --concurrency 8
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator  # noqa: E402
+from harness import make_plugin, serve  # noqa: E402
+
+
+def bench(stub, concurrency):
+    plugin = make_plugin(stub, max_inflight_requests=concurrency)
+    start = time.perf_counter()
+    plugin.loadDevices()
+    elapsed = time.perf_counter() - start
+    plugin.on_shutdown()
+    return elapsed, plugin.devices
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--failing', type=int, default=1, help='number of devices answering with an error')
+    parser.add_argument('--port', type=int, default=5683)
+    args = parser.parse_args()
+
+    stub = GatewaySimulator(devices=args.devices, latency=args.latency, port=args.port,
+                       failing=[65536 + i for i in range(args.failing)])
+    serve(stub)
+
+    sequential, devices = bench(stub, 1)
+    concurrent, concurrent_devices = bench(stub, args.concurrency)
+    assert [d['id'] for d in devices] == [d['id'] for d in concurrent_devices]
+
+    print('devices found:          {:8d}'.format(len(devices)))
+    print('sequential discovery:   {:8.3f} s'.format(sequential))
+    print('concurrent discovery:   {:8.3f} s ({} in flight)'.format(concurrent, args.concurrency))
+    print('speedup:                {:8.1f}x'.format(sequential / concurrent))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# End-to-end benchmark of the plugin's gateway I/O paths against the local gateway simulator. Reports latency
+# percentiles and throughput per operation; results can be saved and compared with a previous run to catch
+# regressions.
+#
+#     python benchmarks/bench_plugin.py --devices 20 --latency 0.01 --observe --output before.json
+#     python benchmarks/bench_plugin.py --devices 20 --latency 0.01 --observe --compare before.json
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import flask
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator  # noqa: E402
+from harness import make_plugin, serve  # noqa: E402
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    index = min(len(samples) - 1, max(0, int(round(p / 100.0 * len(samples))) - 1))
+    return samples[index]
+
+
+def measure(name, fn, iterations):
+    samples = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return dict(name=name, iterations=iterations, throughput=iterations / elapsed,
+                mean=sum(samples) / len(samples), p50=percentile(samples, 50), p90=percentile(samples, 90),
+                p99=percentile(samples, 99))
+
+
+def route(app, plugin, path, handler):
+    def call():
+        with app.test_request_context(path):
+            handler()
+    return call
+
+
+def run(args):
+    simulator = GatewaySimulator(devices=args.devices, latency=args.latency, jitter=args.jitter,
+                                 handshake_delay=args.handshake_delay, loss=args.loss, observe=args.observe,
+                                 port=args.port, seed=1)
+    loop = serve(simulator)
+    plugin = make_plugin(simulator, devices_ttl=0)
+    app = flask.Flask('bench_plugin')
+    device = plugin._settings.get(['selected_devices'])[0]
+
+    results = [measure('loadDevices', plugin.loadDevices, args.iterations)]
+
+    plugin.watchDevices().result()
+    # Let the state engine fill its table before measuring the cached reads
+    deadline = time.time() + 10
+    while len(plugin.states.snapshot()) < args.devices and time.time() < deadline:
+        time.sleep(0.05)
+
+    results += [
+        measure('getStateData', plugin.getStateData, args.iterations),
+        measure('turnOn', lambda: plugin.turnOn(device), args.iterations),
+        measure('turnOff', lambda: plugin.turnOff(device), args.iterations),
+        measure('GET /navbar/info', route(app, plugin, '/navbar/info', plugin.navbarInfo), args.iterations),
+        measure('GET /sidebar/info', route(app, plugin, '/sidebar/info', plugin.sidebarInfo), args.iterations),
+        measure('GET /states', route(app, plugin, '/states?ids=all', plugin.listStates), args.iterations),
+        measure('GET /devices', route(app, plugin, '/devices', plugin.listDevices), args.iterations),
+    ]
+
+    plugin.on_shutdown()
+    asyncio.run_coroutine_threadsafe(simulator.stop(), loop).result()
+    return results
+
+
+def report(results, baseline=None):
+    baseline = dict((result['name'], result) for result in baseline or [])
+    print('{:<20} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'operation', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'ops/s', 'vs baseline'))
+    for result in results:
+        compared = ''
+        if result['name'] in baseline:
+            compared = '{:+.0f}%'.format((result['p50'] / baseline[result['name']]['p50'] - 1) * 100)
+        print('{:<20} {:>8d} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f} {:>12}'.format(
+            result['name'], result['iterations'], result['p50'] * 1000, result['p90'] * 1000,
+            result['p99'] * 1000, result['throughput'], compared))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--handshake-delay', type=float, default=0.05)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--observe', action='store_true')
+    parser.add_argument('--port', type=int, default=5683)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='compare the p50 latencies with the results of a previous run')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Compare gateway GET throughput with a fresh context per request (the former behaviour) against the shared
+# GatewaySession.
+#
+#     python benchmarks/bench_session.py --requests 200 --handshake-delay 0.05
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import sys
+import threading
+import time
+
+import aiocoap
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator  # noqa: E402
+from octoprint_ikea_tradfri.gateway import GatewaySession  # noqa: E402
+
+logger = logging.getLogger('bench_session')
+
+
+def serve(stub):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(stub.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop
+
+
+async def context_per_request(uri):
+    context = await aiocoap.Context.create_client_context()
+    try:
+        return await context.request(aiocoap.Message(code=aiocoap.GET, uri=uri)).response
+    finally:
+        await context.shutdown()
+
+
+def bench_before(uri, requests):
+    pool = concurrent.futures.ThreadPoolExecutor()
+    start = time.perf_counter()
+    for _ in range(requests):
+        pool.submit(asyncio.run, context_per_request(uri)).result()
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return elapsed
+
+
+def bench_after(port, path, requests):
+    session = GatewaySession(logger)
+    session.scheme = 'coap'
+    session.port = port
+    session.configure('127.0.0.1', 'benchmark', 'benchmark-psk')
+    start = time.perf_counter()
+    for _ in range(requests):
+        session.run(session.get(path))
+    elapsed = time.perf_counter() - start
+    session.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=5683)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--handshake-delay', type=float, default=0.05)
+    args = parser.parse_args()
+
+    stub = GatewaySimulator(devices=1, latency=args.latency, handshake_delay=args.handshake_delay, port=args.port)
+    loop = serve(stub)
+    path = '15001/65536'
+
+    before = bench_before('coap://127.0.0.1:{}/{}'.format(args.port, path), args.requests)
+    after = bench_after(args.port, path, args.requests)
+
+    print('context per request: {:8.1f} req/s'.format(args.requests / before))
+    print('shared session:      {:8.1f} req/s'.format(args.requests / after))
+    print('speedup:             {:8.1f}x'.format(before / after))
+
+    asyncio.run_coroutine_threadsafe(stub.stop(), loop).result()
+
+
+if __name__ == '__main__':
+    main()
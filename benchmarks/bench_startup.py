@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Startup wall time against a slow (or unreachable) gateway: how long on_after_startup blocks OctoPrint, how long
+# the background sync takes and how many device states are served right away from the previous run. For
+# comparison, the former blocking startup (discovery then one state request per device) is measured too.
+#
+#     python benchmarks/bench_startup.py --devices 20 --latency 0.2
+#     python benchmarks/bench_startup.py --devices 20 --unreachable
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator  # noqa: E402
+from harness import make_plugin, serve  # noqa: E402
+
+
+def wait_for_startup(plugin, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for message in plugin._plugin_manager.messages:
+            if message['type'] == 'startup' and message['payload']['step'] == 'done':
+                return message['payload']
+        time.sleep(0.01)
+    return None
+
+
+def bench_blocking(simulator, args):
+    plugin = make_plugin(simulator)
+    start = time.perf_counter()
+    plugin.loadDevices(startup=True)
+    for device in plugin._settings.get(['selected_devices']):
+        plugin.run_gateway_get_request('/15001/{}'.format(device['id']))
+    elapsed = time.perf_counter() - start
+    plugin.on_shutdown()
+    return elapsed
+
+
+def bench_background(simulator, args):
+    # Settings as left by a previous run: credentials, inventory and the last known states
+    previous = dict(gateway_credentials=dict(default=dict(identity='benchmark', psk=simulator.psk)),
+                    states=[dict(id=device_id, state=False) for device_id in simulator.devices],
+                    devices=[dict(id=device_id, name=device['9001'], type='3312' in device and 'Outlet' or 'Light')
+                             for device_id, device in simulator.devices.items()])
+    plugin = make_plugin(simulator, **previous)
+
+    start = time.perf_counter()
+    plugin.on_after_startup()
+    returned = time.perf_counter() - start
+    served = sum(1 for item in plugin.getStates('all').values() if item['state'] is not None)
+
+    done = wait_for_startup(plugin, args.timeout)
+    synced = time.perf_counter() - start
+    plugin.on_shutdown()
+    return returned, served, synced, done
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--handshake-delay', type=float, default=0.5)
+    parser.add_argument('--unreachable', action='store_true', help='do not start the simulator at all')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--port', type=int, default=5683)
+    args = parser.parse_args()
+
+    simulator = GatewaySimulator(devices=args.devices, latency=args.latency, handshake_delay=args.handshake_delay,
+                                 port=args.port)
+    loop = None
+    if not args.unreachable:
+        loop = serve(simulator)
+
+    if not args.unreachable:
+        blocking = bench_blocking(simulator, args)
+        print('blocking startup:          {:8.3f} s'.format(blocking))
+
+    returned, served, synced, done = bench_background(simulator, args)
+    print('on_after_startup returned: {:8.3f} s'.format(returned))
+    print('states served at once:     {:8d} / {}'.format(served, args.devices))
+    if done is None:
+        print('background sync:           not done after {} s'.format(args.timeout))
+    else:
+        print('background sync:           {:8.3f} s ({}, {} failed)'.format(synced, done['status'],
+                                                                             len(done['failed'])))
+
+    if loop is not None:
+        asyncio.run_coroutine_threadsafe(simulator.stop(), loop).result()
+
+
+if __name__ == '__main__':
+    main()
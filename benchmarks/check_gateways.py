@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Scenario checks of the gateway handling against the simulator, exits with 1 when one of them fails.
+#
+#     python benchmarks/check_gateways.py
+
+import asyncio
+import copy
+import os
+import sys
+import types
+
+import aiocoap
+import aiocoap.error
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gateway_simulator import GatewaySimulator  # noqa: E402
+from harness import make_plugin, selected_device, serve  # noqa: E402
+
+PORT = 5697
+
+
+class FatalDTLSError(Exception):
+    # What the DTLS layer raises when the gateway aborts the handshake, only its name matters
+    pass
+
+
+def rejection():
+    error = aiocoap.error.NetworkError('Handshake aborted by the gateway')
+    error.__cause__ = FatalDTLSError()
+    return error
+
+
+def revocable(session, revoked, created, rejected):
+    # Contexts of the session behave like those of a gateway which refuses the PSKs in `revoked`: the simulator
+    # speaks plain CoAP and accepts any client.
+    create_context = session._create_context
+
+    async def create():
+        context = await create_context()
+        psk = session._credentials[2]
+        created.append(psk)
+        request = context.request
+
+        def guarded(message, **kwargs):
+            if psk not in revoked:
+                return request(message, **kwargs)
+            # True for a context left over from credentials the session already replaced
+            rejected.append(session._credentials[2] != psk)
+            future = asyncio.get_event_loop().create_future()
+            future.set_exception(rejection())
+            return types.SimpleNamespace(response=future)
+
+        context.request = guarded
+        return context
+
+    session._create_context = create
+
+
+def check_reauth_retry(simulator):
+    # The gateway revokes the PSK while idle contexts still hold it: after the re-auth, the retry must run on a
+    # new context with the new PSK instead of picking up one of the old ones.
+    plugin = make_plugin(simulator, selected=[],
+                         gateway_credentials=dict(default=dict(identity='check', psk=simulator.psk)))
+    session = plugin.session
+    revoked, created, rejected = set(), [], []
+    revocable(session, revoked, created, rejected)
+    try:
+        async def fill():
+            # Concurrent requests, each on its own context
+            await asyncio.gather(*[plugin._run_gateway_get_request('15001/{}'.format(device_id))
+                                   for device_id in list(simulator.devices)[:4]])
+
+        simulator.latency = 0.05
+        session.run(fill())
+        simulator.latency = 0.0
+        idle = len(session._idle)
+
+        old_psk = simulator.psk
+        revoked.add(old_psk)
+        simulator.psk = 'check-new-psk'
+        # A PUT runs on the task of the caller: nothing else gets to run on the loop before the retry
+        result = plugin.run_gateway_put_request('15001/65536', {'3312': [{'5850': 1}]})
+
+        failures = []
+        if idle < 4:
+            failures.append('expected 4 idle contexts before the revocation, got %d' % idle)
+        if result is None:
+            failures.append('the request after the re-auth failed (%d rejected attempts)' % len(rejected))
+        if any(rejected):
+            failures.append('the retry used a context of the revoked PSK')
+        if plugin.getGateway().psk != simulator.psk:
+            failures.append('the new PSK was not stored')
+        if not created or created[-1] != simulator.psk:
+            failures.append('the retry did not open a context with the new PSK')
+        return failures
+    finally:
+        simulator.psk = 'benchmark-psk'
+        plugin.on_shutdown()
+
+
+def merge(target, source):
+    # What `$.extend(true, target, source)` does to the sidebar state of the browser: objects and arrays are
+    # merged key by key, or index by index, anything else is replaced.
+    for key, value in (source.items() if isinstance(source, dict) else enumerate(source)):
+        if isinstance(value, (dict, list)):
+            current = target[key] if isinstance(target, dict) and key in target or \
+                isinstance(target, list) and key < len(target) else None
+            if not isinstance(current, type(value)):
+                current = type(value)()
+            value = merge(current, value)
+        if isinstance(target, list) and key >= len(target):
+            target.append(value)
+        else:
+            target[key] = value
+    return target
+
+
+def check_sidebar_gateway_removal(simulator):
+    # A gateway removed in the settings must disappear from the sidebar of the browser, which applies partial
+    # updates on top of its previous state.
+    plugin = make_plugin(simulator, selected=[],
+                         gateways=[dict(id='office', name='Office', gateway_ip='127.0.0.2', security_code='check')])
+    try:
+        plugin.pushSidebar()
+        plugin._settings.set(['gateways'], [])
+        plugin.loadGateways()
+        plugin.pushSidebar()
+
+        state = dict()
+        for message in plugin._plugin_manager.messages:
+            if message['type'] == 'sidebar':
+                state = merge(copy.deepcopy(state), message['payload']) if message['partial'] else message['payload']
+
+        failures = []
+        expected = plugin.sidebarInfoData()['gateways']
+        shown = state.get('gateways') or dict()
+        if shown != expected:
+            names = shown.values() if isinstance(shown, dict) else shown
+            failures.append('the sidebar shows the gateways %s' % ', '.join(sorted(info['name'] for info in names)))
+        return failures
+    finally:
+        plugin.on_shutdown()
+
+
+def check_gateway_ids(simulator):
+    # Other gateways whose id collides with the default gateway, with one another or with the device keys are
+    # dropped, on load as well as by the settings migration.
+    gateways = [dict(id='default', name='Shadow', gateway_ip='127.0.0.9', security_code='check'),
+                dict(id='', name='Unnamed', gateway_ip='127.0.0.3', security_code='check'),
+                dict(id=' office ', name='Office', gateway_ip='127.0.0.2', security_code='check'),
+                dict(id='office', name='Office copy', gateway_ip='127.0.0.4', security_code='check'),
+                dict(id='hall/1', name='Hall', gateway_ip='127.0.0.5', security_code='check')]
+    plugin = make_plugin(simulator, selected=[], gateways=gateways)
+    try:
+        failures = []
+        if sorted(plugin.gateways) != ['default', 'office']:
+            failures.append('loaded the gateways %s' % ', '.join(sorted(plugin.gateways)))
+        if plugin.getGateway().ip != '127.0.0.1':
+            failures.append('the default gateway moved to %s' % plugin.getGateway().ip)
+        if plugin.getGateway('office').ip != '127.0.0.2':
+            failures.append('the gateway office is at %s' % plugin.getGateway('office').ip)
+
+        plugin.on_settings_migrate(8, 7)
+        stored = [(item['id'], item['name']) for item in plugin._settings.get(['gateways'])]
+        if stored != [('office', 'Office')]:
+            failures.append('the migration kept the gateways %s' % stored)
+        return failures
+    finally:
+        plugin.on_shutdown()
+
+
+CHECKS = [check_reauth_retry, check_sidebar_gateway_removal, check_gateway_ids]
+
+
+def main():
+    simulator = GatewaySimulator(devices=4, port=PORT)
+    serve(simulator)
+
+    failed = 0
+    for check in CHECKS:
+        failures = check(simulator)
+        print('{:<40} {}'.format(check.__name__, 'ok' if not failures else 'FAILED'))
+        for failure in failures:
+            print('    ' + failure)
+        failed += bool(failures)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
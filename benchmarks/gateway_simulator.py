@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Local Tradfri gateway simulator, speaking plain CoAP on localhost.
+#
+# It models the resources the plugin uses: the 15011/9063 auth, the 15001 device list, per device GET/PUT of
+# outlets (3312) and lights (3311), the 15004 groups and, optionally, Observe on the devices.
+#
+# There is no DTLS here, so its costs are simulated: the first request seen from a new client endpoint (every
+# fresh aiocoap context binds a new socket) is delayed by `handshake_delay` seconds. A lost datagram is modeled
+# as the retransmission delay it costs the client: `loss` is the probability of a request being delayed by
+# `loss_penalty` seconds (the CoAP ACK_TIMEOUT).
+#
+#     python benchmarks/gateway_simulator.py --devices 40 --latency 0.02 --observe
+
+import argparse
+import asyncio
+import json
+import random
+
+import aiocoap
+import aiocoap.interfaces
+import aiocoap.resource
+
+
+class GatewayResource(aiocoap.resource.Resource, aiocoap.resource.PathCapable,
+                      aiocoap.interfaces.ObservableResource):
+
+    def __init__(self, gateway):
+        super(GatewayResource, self).__init__()
+        self.gateway = gateway
+
+    async def add_observation(self, request, serverobservation):
+        self.gateway.add_observation(request, serverobservation)
+
+    async def render_to_pipe(self, pipe):
+        return await aiocoap.interfaces.ObservableResource._render_to_pipe(self, pipe)
+
+    async def render(self, request):
+        await self.gateway.delay(request)
+        return self.gateway.handle(request)
+
+
+class GatewaySimulator(object):
+
+    def __init__(self, devices=10, latency=0.0, jitter=0.0, handshake_delay=0.0, loss=0.0, loss_penalty=2.0,
+                 observe=False, port=5683, failing=(), groups=(), psk='benchmark-psk', seed=None, host='127.0.0.1'):
+        self.latency = latency
+        self.jitter = jitter
+        self.handshake_delay = handshake_delay
+        self.loss = loss
+        self.loss_penalty = loss_penalty
+        self.observe = observe
+        self.port = port
+        self.host = host
+        self.failing = set(failing)
+        self.psk = psk
+        self.devices = dict()
+        self.groups = dict()
+        self.identities = []
+        self.requests = 0
+        self.lost = 0
+        self._random = random.Random(seed)
+        self._remotes = set()
+        self._observations = dict()
+        self._context = None
+        for i in range(devices):
+            device_id = 65536 + i
+            code = '3312' if i % 2 == 0 else '3311'
+            self.devices[device_id] = {'9001': 'Device {}'.format(i), '9003': device_id, code: [{'5850': 0}]}
+        for i, members in enumerate(groups):
+            group_id = 131072 + i
+            self.groups[group_id] = {'9001': 'Group {}'.format(i), '9003': group_id, '5850': 0,
+                                     '9018': {'15002': {'9003': [65536 + m for m in members]}}}
+
+    async def delay(self, request):
+        self.requests += 1
+        remote = request.remote.hostinfo
+        if remote not in self._remotes:
+            self._remotes.add(remote)
+            if self.handshake_delay:
+                await asyncio.sleep(self.handshake_delay)
+        if self.loss and self._random.random() < self.loss:
+            self.lost += 1
+            await asyncio.sleep(self.loss_penalty)
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+
+    def add_observation(self, request, serverobservation):
+        path = list(request.opt.uri_path)
+        if not self.observe or len(path) != 2 or path[0] != '15001' or int(path[1]) not in self.devices:
+            return
+        observers = self._observations.setdefault(int(path[1]), set())
+        observers.add(serverobservation)
+        serverobservation.accept(lambda: observers.discard(serverobservation))
+
+    def set_state(self, device_id, values):
+        # Switch a device as if it was done from outside of the plugin (remote control, app, ...)
+        device = self.devices[device_id]
+        for code in ('3311', '3312'):
+            if code in device:
+                device[code][0].update(values)
+        for serverobservation in list(self._observations.get(device_id, ())):
+            serverobservation.trigger()
+
+    def handle(self, request):
+        path = list(request.opt.uri_path)
+        if path == ['15011', '9063'] and request.code == aiocoap.POST:
+            self.identities.append(json.loads(request.payload).get('9090'))
+            return self.json(aiocoap.CREATED, {'9091': self.psk, '9029': '1.0.0'})
+        if path == ['15001'] and request.code == aiocoap.GET:
+            return self.json(aiocoap.CONTENT, list(self.devices))
+        if path == ['15004'] and request.code == aiocoap.GET:
+            return self.json(aiocoap.CONTENT, list(self.groups))
+        if len(path) == 2 and path[0] == '15004' and int(path[1]) in self.groups:
+            group = self.groups[int(path[1])]
+            if request.code == aiocoap.GET:
+                return self.json(aiocoap.CONTENT, group)
+            if request.code == aiocoap.PUT:
+                values = json.loads(request.payload)
+                group.update(values)
+                for device_id in group['9018']['15002']['9003']:
+                    self.set_state(device_id, values)
+                return aiocoap.Message(code=aiocoap.CHANGED)
+        if len(path) == 2 and path[0] == '15001' and int(path[1]) in self.failing:
+            return aiocoap.Message(code=aiocoap.SERVICE_UNAVAILABLE)
+        if len(path) == 2 and path[0] == '15001' and int(path[1]) in self.devices:
+            device_id = int(path[1])
+            if request.code == aiocoap.GET:
+                return self.json(aiocoap.CONTENT, self.devices[device_id])
+            if request.code == aiocoap.PUT:
+                for code, values in json.loads(request.payload).items():
+                    if code in self.devices[device_id]:
+                        self.set_state(device_id, values[0])
+                return aiocoap.Message(code=aiocoap.CHANGED)
+        return aiocoap.Message(code=aiocoap.NOT_FOUND)
+
+    def json(self, code, payload):
+        return aiocoap.Message(code=code, payload=json.dumps(payload).encode())
+
+    async def start(self):
+        self._context = await aiocoap.Context.create_server_context(GatewayResource(self),
+                                                                    bind=(self.host, self.port))
+        return self
+
+    async def stop(self):
+        if self._context is not None:
+            await self._context.shutdown()
+            self._context = None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--handshake-delay', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--observe', action='store_true')
+    parser.add_argument('--port', type=int, default=5683)
+    args = parser.parse_args()
+
+    simulator = GatewaySimulator(devices=args.devices, latency=args.latency, jitter=args.jitter,
+                                 handshake_delay=args.handshake_delay, loss=args.loss, observe=args.observe,
+                                 port=args.port)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(simulator.start())
+    print('Gateway simulator listening on coap://127.0.0.1:{}'.format(args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.run_until_complete(simulator.stop())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Wires an IkeaTradfriPlugin to a GatewaySimulator with in-memory settings, printer and plugin manager so the
+# plugin's gateway paths can be measured without a running OctoPrint server.
+
+import asyncio
+import copy
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import octoprint_ikea_tradfri  # noqa: E402
+from octoprint_ikea_tradfri.gateway import GatewaySession  # noqa: E402
+
+
+class MemorySettings(object):
+
+    def __init__(self, values):
+        self.values = values
+        self.saves = 0
+
+    def get(self, path, **kwargs):
+        value = self.values
+        for key in path:
+            if key not in value:
+                return None
+            value = value[key]
+        return copy.deepcopy(value)
+
+    def get_int(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def get_boolean(self, path, **kwargs):
+        return bool(self.get(path))
+
+    def set(self, path, value, **kwargs):
+        target = self.values
+        for key in path[:-1]:
+            target = target.setdefault(key, dict())
+        target[path[-1]] = value
+
+    def remove(self, path, **kwargs):
+        target = self.get(path[:-1]) if len(path) > 1 else self.values
+        target.pop(path[-1], None)
+
+    def save(self, *args, **kwargs):
+        self.saves += 1
+
+
+class IdlePrinter(object):
+
+    def get_current_temperatures(self):
+        return dict(bed=dict(actual=20), tool0=dict(actual=20))
+
+    def is_printing(self):
+        return False
+
+    def is_pausing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+    def is_cancelling(self):
+        return False
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+class PluginManager(object):
+    enabled_plugins = []
+
+    def __init__(self):
+        self.messages = []
+
+    def get_helpers(self, *args):
+        return dict()
+
+    def send_plugin_message(self, identifier, payload):
+        self.messages.append(payload)
+
+
+def selected_device(device_id, device_type='Outlet'):
+    return dict(name='Printer {}'.format(device_id), id=device_id, type=device_type, connection_timer=-2,
+                stop_timer=30, postpone_delay=30, turn_off_mode='time', cooldown_bed=-1, cooldown_hotend=50,
+                on_done=True, on_failed=False, icon='plug', nav_name=False, nav_icon=True, connect_palette2=False)
+
+
+def serve(stub):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(stub.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def make_plugin(stub, selected=None, **settings):
+    GatewaySession.scheme = 'coap'
+    GatewaySession.port = stub.port
+
+    plugin = octoprint_ikea_tradfri.IkeaTradfriPlugin()
+    plugin._identifier = 'ikea_tradfri'
+    plugin._logger = logging.getLogger('octoprint.plugins.ikea_tradfri')
+    plugin._printer = IdlePrinter()
+    plugin._plugin_manager = PluginManager()
+    # History log and other plugin data, thrown away with the run
+    plugin._data_folder = tempfile.mkdtemp()
+
+    values = plugin.get_settings_defaults()
+    values.update(gateway_ip='127.0.0.1', security_code='benchmark')
+    if selected is None:
+        selected = [selected_device(device_id, '3312' in device and 'Outlet' or 'Light')
+                    for device_id, device in stub.devices.items()]
+    values['selected_devices'] = selected
+    values.update(settings)
+    plugin._settings = MemorySettings(values)
+    plugin.initialize()
+    return plugin
@@ -2,10 +2,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import asyncio
+import collections
 import concurrent.futures
+import functools
 import json
 import math
-import threading
 import time
 import uuid
 
@@ -24,40 +25,116 @@ from flask_babel import gettext
 from octoprint.access import ADMIN_GROUP
 
 from . import cli
-
-userId = str(uuid.uuid1())[:8]
+from .breaker import CLOSED, CircuitBreaker, GatewayUnavailable
+from .cooldown import CooldownPredictor
+from .gateway import GatewaySession, device_label, is_rejection
+from .gateways import DEFAULT_GATEWAY, Gateway, device_key, gateway_id_error, native_id, parse_key
+from .history import HistoryLog
+from .jobs import CommandFailed, JobQueue
+from .lights import SETTINGS as LIGHT_SETTINGS, LightController
+from .metrics import Metrics
+from .mqtt import MessageQueue, StatePublisher
+from .persistence import SettingsWriter
+from .push import PushChannel
+from .registry import DeviceRecord, DeviceRegistry
+from .scheduler import Scheduler
+from .stream import StateStream
+from .state import StateEngine
+
+# Minimum delay between two auth attempts triggered by rejected credentials
+AUTH_RETRY_DELAY = 30
+AUTH_TIMEOUT = 30
 
 
 class IkeaTradfriPlugin(
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.WizardPlugin,
     octoprint.plugin.BlueprintPlugin):
-    psk = None
+    startedAt = None
+    firstStatePending = False
+    stream = None
     devices = []
+    groups = []
+    devicesLoadedAt = None
     status = 'waiting'
     error_message = ''
     shutdownAt = dict()
-    stopTimer = dict()
     stopCooldown = dict()
-    pool = concurrent.futures.ThreadPoolExecutor()
+    cooldownEta = dict()
+    cooldown = None
+    scheduler = None
+    push = None
+    session = None
+    states = None
+    jobs = None
+    lights = None
+    metrics = None
+    writer = None
+    mqttQueue = None
+    statePublisher = None
+    history = None
+    mqttPrefix = None
     baseTopic = None
 
 
     def __init__(self):
+        self.registry = DeviceRegistry()
+        self.gateways = dict()
         self.mqtt_publish = lambda *args, **kwargs: None
         self.mqtt_subscribe = lambda *args, **kwargs: None
         self.mqtt_unsubscribe = lambda *args, **kwargs: None
-
-    async def _auth(self, gateway_ip, security_code):
+        self.mqttRoutes = dict()
+        # Source of the switch each device is waiting for, what the history records for its next change
+        self.sources = dict()
+        self.lightSources = dict()
+
+    def initialize(self):
+        self.registry.rebuild(self._settings.get(['selected_devices']))
+        self.metrics = Metrics()
+        # Owns the event loop the sessions of the other gateways share
+        self.session = GatewaySession(self._logger, metrics=self.metrics, breaker=self.createBreaker(DEFAULT_GATEWAY))
+        self.states = StateEngine(self.session, self._logger, self._connect_session, self.on_state_change,
+                                  poll_interval=int(self._settings.get(['state_poll_interval'])),
+                                  on_rejected=self.authenticate, sessions=self.getSession)
+        self.scheduler = Scheduler(self._logger)
+        self.writer = SettingsWriter(self._settings, self.scheduler, self._logger, self.metrics,
+                                     delay=float(self._settings.get(['settings_save_delay'])))
+        self.push = PushChannel(self._send_message)
+        self.stream = StateStream()
+        self.jobs = JobQueue(self._logger, self.on_job_done, max_workers=int(self._settings.get(['job_workers'])))
+        self.lights = LightController(self.scheduler, self.queueLight,
+                                      rate=float(self._settings.get(['light_update_rate'])))
+        self.mqttQueue = MessageQueue(self._logger, self.metrics, maxsize=int(self._settings.get(['mqtt_queue_size'])),
+                                      workers=int(self._settings.get(['mqtt_workers'])))
+        self.statePublisher = StatePublisher(self.mqtt_publish_ikea, self.scheduler, self.states.snapshot,
+                                             heartbeat=int(self._settings.get(['mqtt_heartbeat_interval'])))
+        self.cooldown = CooldownPredictor(ambient=float(self._settings.get(['cooldown_ambient'])))
+        self.history = HistoryLog(self.get_plugin_data_folder(), self.scheduler, self._logger, self.metrics,
+                                  flush_delay=float(self._settings.get(['history_flush_delay'])),
+                                  retention=int(self._settings.get(['history_retention_days'])) * 86400)
+
+        self.loadGateways()
+
+        # Inventory and states of the previous run are served until the startup sync is done
+        self.devices = self._settings.get(['devices']) or []
+        self.groups = self._settings.get(['groups']) or []
+        self.states.restore(dict((item['id'], item['state']) for item in self._settings.get(['states']) or []))
+        self.stream.update(self.states.snapshot())
+
+    async def _auth(self, gateway_ip, security_code, identity):
+        # The auth exchange uses the gateway security code as PSK, so it gets its own short lived context
+        # instead of the session one.
+        start = time.perf_counter()
         context = await aiocoap.Context.create_client_context()
         # context.log.setLevel(level="DEBUG")
         context.client_credentials.load_from_dict({
-            ('coaps://{}:5684/*'.format(gateway_ip)): {
+            ('{}/*'.format(self.session.base_uri(gateway_ip))): {
                 'dtls': {
                     'psk': security_code.encode(),
                     'client-identity': b"Client_identity"
@@ -66,14 +143,14 @@ class IkeaTradfriPlugin(
         })
 
         payload = dict()
-        payload["9090"] = userId
+        payload["9090"] = identity
         payload = json.dumps(payload)
 
-        uri = 'coaps://{}:5684/{}'.format(gateway_ip, "15011/9063")
+        uri = '{}/{}'.format(self.session.base_uri(gateway_ip), "15011/9063")
         req = aiocoap.Message(code=aiocoap.Code.POST, uri=uri, payload=payload.encode())
 
         try:
-            response = await context.request(req).response
+            response = await asyncio.wait_for(context.request(req).response, AUTH_TIMEOUT)
         except Exception as e:
             self._logger.error('auth(): Failed to fetch resource:')
             self._logger.error(e)
@@ -86,66 +163,187 @@ class IkeaTradfriPlugin(
                 self._logger.error(e)
             else:
                 return resPayload["9091"] if "9091" in resPayload else None
+        finally:
+            await context.shutdown()
+            self.metrics.observe('auth', time.perf_counter() - start)
 
         return None
 
-    async def auth(self):
-        gateway_ip = self._settings.get(["gateway_ip"])
-        security_code = self._settings.get(["security_code"])
-
-        # token = self.pool.submit(asyncio.run, self._auth(gateway_ip, security_code)).result()
-        # return token
-        token = await self._auth(gateway_ip, security_code)
-        return token
+    async def authenticate(self, gateway_id=DEFAULT_GATEWAY, rejected=None):
+        # Single flight per gateway: concurrent callers wait on the same auth exchange. `rejected` is the psk the
+        # gateway refused, nothing to do when it was already replaced.
+        gateway = self.getGateway(gateway_id)
+        if gateway is None:
+            return False
+        if rejected is None:
+            rejected = gateway.psk
+        if gateway.psk is not None and gateway.psk != rejected:
+            return True
+        if gateway.authenticating is None:
+            if gateway.authAt is not None and time.time() - gateway.authAt < AUTH_RETRY_DELAY:
+                return gateway.psk is not None and gateway.psk != rejected
+            gateway.authenticating = asyncio.ensure_future(self._authenticate(gateway))
+            gateway.authenticating.add_done_callback(functools.partial(self._authenticated, gateway))
+        return await asyncio.shield(gateway.authenticating)
+
+    def _authenticated(self, gateway, task):
+        gateway.authenticating = None
+
+    async def _authenticate(self, gateway):
+        # The gateway refuses to register an identity twice, every auth gets a new one
+        identity = str(uuid.uuid1())[:8]
+        gateway.authAt = time.time()
+        self._logger.info('Authenticate on gateway %s (%s) as %s' % (gateway.id, gateway.ip, identity))
+        psk = await self._auth(gateway.ip, gateway.security_code, identity)
+        if psk is None:
+            return False
+        self.storeCredentials(gateway, identity, psk)
+        return True
+
+    def storeCredentials(self, gateway, identity, psk):
+        gateway.identity = identity
+        gateway.psk = psk
+        self.writer.set(['gateway_credentials'], dict((item.id, dict(identity=item.identity, psk=item.psk))
+                                                      for item in self.gateways.values() if item.psk is not None))
+
+    def createBreaker(self, gateway_id):
+        return CircuitBreaker(threshold=int(self._settings.get(['breaker_threshold'])),
+                              reset_timeout=int(self._settings.get(['breaker_reset_timeout'])),
+                              on_change=functools.partial(self.on_breaker_change, gateway_id))
+
+    def gatewaySettings(self):
+        # id -> (name, ip, security code, request limit) of the default gateway and of the `gateways` setting
+        items = [dict(id=DEFAULT_GATEWAY, name='Gateway', gateway_ip=self._settings.get(['gateway_ip']),
+                      security_code=self._settings.get(['security_code']))]
+        items.extend(self.validGateways(self._settings.get(['gateways'])))
+        res = dict()
+        for item in items:
+            gateway_id = item['id']
+            res[gateway_id] = (item.get('name') or gateway_id, item.get('gateway_ip') or "",
+                               item.get('security_code') or "", item.get('max_inflight_requests'))
+        return res
 
-    def save_settings(self):
-        self._settings.set(['status'], self.status)
-        self._settings.set(['error_message'], self.error_message)
-        self._settings.set(['devices'], self.devices)
-        self._settings.save()
-        self._logger.debug('Settings saved')
-
-    def run_gateway_get_request(self, path):
-        res = self.pool.submit(asyncio.run, self._run_gateway_get_request(path)).result()
+    def validGateways(self, gateways):
+        # Entries of the `gateways` setting whose id names them unambiguously, the others are dropped: an empty or
+        # duplicate id, or 'default', would silently replace another gateway.
+        res = []
+        taken = set()
+        for item in gateways or []:
+            gateway_id = str(item.get('id') or '').strip()
+            error = gateway_id_error(gateway_id, taken)
+            if error is not None:
+                self._logger.warning('Ignore gateway %s: %s' % (item.get('name') or gateway_id, error))
+                continue
+            taken.add(gateway_id)
+            res.append(dict(item, id=gateway_id))
         return res
 
-    async def _run_gateway_get_request(self, path):
-        gateway_ip = self._settings.get(["gateway_ip"])
+    def loadGateways(self):
+        credentials = self._settings.get(['gateway_credentials']) or dict()
+        gateways = dict()
+        for gateway_id, (name, ip, security_code, size) in self.gatewaySettings().items():
+            gateway = self.gateways.get(gateway_id)
+            if gateway is None:
+                if gateway_id == DEFAULT_GATEWAY:
+                    session = self.session
+                else:
+                    session = GatewaySession(self._logger, metrics=self.metrics,
+                                             breaker=self.createBreaker(gateway_id), parent=self.session)
+                gateway = Gateway(gateway_id, name, ip, security_code, session)
+                # Credentials from a previous run, the gateway keeps them until it rejects them
+                stored = credentials.get(gateway_id) or dict()
+                if stored.get('identity') and stored.get('psk'):
+                    gateway.identity = stored['identity']
+                    gateway.psk = stored['psk']
+            elif (gateway.ip, gateway.security_code) != (ip, security_code):
+                # The credentials belong to the former gateway
+                gateway.ip = ip
+                gateway.security_code = security_code
+                self.resetAuth(gateway)
+            gateway.name = name
+            gateway.max_inflight_requests = size
+            gateways[gateway_id] = gateway
+
+        removed = [gateway for gateway_id, gateway in self.gateways.items() if gateway_id not in gateways]
+        self.gateways = gateways
+        self.tuneSessions()
+        for gateway in removed:
+            self._logger.info('Remove gateway %s' % gateway.id)
+            gateway.session.close()
+        if len(removed):
+            self.storeCredentials(self.gateways[DEFAULT_GATEWAY], self.gateways[DEFAULT_GATEWAY].identity,
+                                  self.gateways[DEFAULT_GATEWAY].psk)
+
+    def getGateway(self, gateway_id=DEFAULT_GATEWAY):
+        return self.gateways.get(gateway_id or DEFAULT_GATEWAY)
+
+    def getSession(self, gateway_id=DEFAULT_GATEWAY):
+        gateway = self.getGateway(gateway_id)
+        return None if gateway is None else gateway.session
 
-        if self.psk is None:
-            self.psk = await self.auth()
-        if self.psk is None:
-            self.status = 'connection_failled'
-            self._logger.error('Failed to get psk key (run_gateway_get_request)')
-            self.save_settings()
+    def save_settings(self):
+        # status and error_message only live in memory, see on_settings_load
+        self.writer.set(['devices'], self.devices)
+        self.writer.set(['groups'], self.groups)
+        self.writer.set(['states'], [dict(id=device_id, state=item['state'])
+                                     for device_id, item in self.states.snapshot().items()])
+
+    async def _connect_session(self, gateway_id=DEFAULT_GATEWAY):
+        gateway = self.getGateway(gateway_id)
+        if gateway is None:
+            self._logger.error('Unknown gateway %s (run_gateway_request)' % gateway_id)
+            return False
+
+        if gateway.psk is None:
+            await self.authenticate(gateway.id)
+        if gateway.psk is None:
+            gateway.status = 'connection_failled'
+            if gateway.id == DEFAULT_GATEWAY:
+                self.status = 'connection_failled'
+            self._logger.error('Failed to get psk key of gateway %s (run_gateway_request)' % gateway.id)
+            return False
+
+        gateway.session.configure(gateway.ip, gateway.identity, gateway.psk)
+        return True
+
+    def tuneSessions(self):
+        # Request limits, cache and timeouts of the sessions, read from the settings at startup and on save only:
+        # not on every request
+        timeouts = dict(get=self._settings.get(['gateway_get_timeout']),
+                        put=self._settings.get(['gateway_put_timeout']))
+        for gateway in self.gateways.values():
+            gateway.session.tune(size=gateway.max_inflight_requests or self._settings.get(['max_inflight_requests']),
+                                 result_ttl=self._settings.get(['gateway_result_ttl']), timeouts=timeouts,
+                                 retries=self._settings.get(['gateway_retries']))
+
+    def run_gateway_get_request(self, path, decode=json.loads, gateway=DEFAULT_GATEWAY):
+        session = self.getSession(gateway)
+        if session is None:
+            self._logger.error('run_gateway_get_request(): Unknown gateway %s' % gateway)
+            return None
+        try:
+            return session.run(self._run_gateway_get_request(path, decode, gateway),
+                               timeout=session.deadline('get') + AUTH_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self._logger.error('run_gateway_get_request(): No result for %s in time' % path)
             return None
 
-        uri = 'coaps://{}:5684/{}'.format(gateway_ip, path)
-
-        context = await aiocoap.Context.create_client_context()
-        # context.log.setLevel(level="DEBUG")
-        context.client_credentials.load_from_dict({
-            ('coaps://{}:5684/*'.format(gateway_ip)): {
-                'dtls': {
-                    'psk': self.psk.encode(),
-                    'client-identity': userId.encode()
-                }
-            }
-        })
-
-        # self._logger.debug(api)
-
-        req = aiocoap.Message(code=aiocoap.Code.GET, uri=uri)
+    async def _run_gateway_get_request(self, path, decode=json.loads, gateway=DEFAULT_GATEWAY):
+        if not await self._connect_session(gateway):
+            return None
 
         try:
-            response = await context.request(req).response
+            response = await self._gateway_request(gateway, 'get', path)
+        except GatewayUnavailable as e:
+            self._logger.debug('_run_gateway_get_request(): %s' % e)
         except Exception as e:
             self._logger.error('_run_gateway_get_request(): Failed to fetch resource:')
             self._logger.error(e)
         else:
             self._logger.debug('Result: %s\n%r' % (response.code, response.payload))
             try:
-                resPayload = json.loads(response.payload)
+                with self.metrics.timer('decode', device_label(path)):
+                    resPayload = decode(response.payload)
             except ValueError as e:
                 self._logger.error("Failed to parse auth response")
                 self._logger.error(e)
@@ -154,52 +352,46 @@ class IkeaTradfriPlugin(
 
         return None
 
-    def run_gateway_put_request(self, path, data):
-        res = self.pool.submit(asyncio.run, self._run_gateway_put_request(path, data)).result()
-        return res
-
-    async def _run_gateway_put_request(self, path, data):
-        gateway_ip = self._settings.get(["gateway_ip"])
-
-        if self.psk is None:
-            self.psk = await self.auth()
-        if self.psk is None:
-            self.status = 'connection_failled'
-            self._logger.error('Failed to get psk key (run_gateway_get_request)')
-            self.save_settings()
+    def run_gateway_put_request(self, path, data, gateway=DEFAULT_GATEWAY):
+        session = self.getSession(gateway)
+        if session is None:
+            self._logger.error('run_gateway_put_request(): Unknown gateway %s' % gateway)
+            return None
+        try:
+            return session.run(self._run_gateway_put_request(path, data, gateway),
+                               timeout=session.deadline('put') + AUTH_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            self._logger.error('run_gateway_put_request(): No result for %s in time' % path)
             return None
 
-        uri = 'coaps://{}:5684/{}'.format(gateway_ip, path)
-
-        context = await aiocoap.Context.create_client_context()
-        # context.log.setLevel(level="DEBUG")
-        context.client_credentials.load_from_dict({
-            ('coaps://{}:5684/*'.format(gateway_ip)): {
-                'dtls': {
-                    'psk': self.psk.encode(),
-                    'client-identity': userId.encode()
-                }
-            }
-        })
+    async def _run_gateway_put_request(self, path, data, gateway=DEFAULT_GATEWAY):
+        if not await self._connect_session(gateway):
+            return None
 
-        # self._logger.debug(api)
-        if isinstance(data, str):
+        if isinstance(data, bytes):
             payload = data
+        elif isinstance(data, str):
+            payload = data.encode()
         else:
-            payload = json.dumps(data)
-
-        req = aiocoap.Message(code=aiocoap.Code.PUT, uri=uri, payload=payload.encode())
+            payload = json.dumps(data).encode()
 
         try:
-            response = await context.request(req).response
+            response = await self._gateway_request(gateway, 'put', path, payload)
+        except GatewayUnavailable as e:
+            self._logger.debug('_run_gateway_put_request(): %s' % e)
         except Exception as e:
             self._logger.error('_run_gateway_put_request(): Failed to fetch resource:')
             self._logger.error(e)
         else:
             self._logger.debug('Result: %s\n%r' % (response.code, response.payload))
+            if not response.code.is_successful():
+                # The switch did not happen, the state cache must not pretend it did
+                self._logger.error('_run_gateway_put_request(): %s answered %s' % (path, response.code))
+                return None
             if response.payload:
                 try:
-                    resPayload = json.loads(response.payload)
+                    with self.metrics.timer('decode', device_label(path)):
+                        resPayload = json.loads(response.payload)
                 except ValueError as e:
                     self._logger.error("Failed to parse auth response")
                     self._logger.error(e)
@@ -210,38 +402,173 @@ class IkeaTradfriPlugin(
 
         return None
 
+    async def _gateway_request(self, gateway_id, method, *args):
+        gateway = self.getGateway(gateway_id)
+        psk = gateway.psk
+        try:
+            return await getattr(gateway.session, method)(*args)
+        except aiocoap.error.NetworkError as e:
+            if not is_rejection(e):
+                raise
+            self._logger.warn('Gateway %s rejected the credentials of %s' % (gateway.id, gateway.identity))
+            if not await self.authenticate(gateway.id, rejected=psk) or not await self._connect_session(gateway.id):
+                raise
+        return await getattr(gateway.session, method)(*args)
+
+    async def _discover_devices(self, gateway_id=DEFAULT_GATEWAY):
+        deviceIds = await self._run_gateway_get_request('15001', gateway=gateway_id)
+        if deviceIds is None:
+            return None
+
+        # The session caps how many of these requests are in flight to the gateway at once
+        results = await asyncio.gather(*[self._run_gateway_get_request('15001/{}'.format(deviceId), gateway=gateway_id)
+                                         for deviceId in deviceIds], return_exceptions=True)
+
+        devices = []
+        for deviceId, dev in zip(deviceIds, results):
+            if dev is None or isinstance(dev, Exception):
+                self._logger.warn('Failed to load device %s: %s' % (deviceId, dev))
+                continue
+            key = device_key(gateway_id, deviceId)
+            if '3312' in dev:
+                devices.append(dict(id=key, name=dev['9001'], type="Outlet", gateway=gateway_id))
+            elif '3311' in dev:  # Lights
+                devices.append(dict(id=key, name=dev['9001'], type="Light", gateway=gateway_id))
+        return devices
+
+    async def _discover_groups(self, gateway_id=DEFAULT_GATEWAY):
+        groupIds = await self._run_gateway_get_request('15004', gateway=gateway_id)
+        if groupIds is None:
+            return None
+
+        results = await asyncio.gather(*[self._run_gateway_get_request('15004/{}'.format(groupId), gateway=gateway_id)
+                                         for groupId in groupIds], return_exceptions=True)
+
+        groups = []
+        for groupId, group in zip(groupIds, results):
+            if group is None or isinstance(group, Exception):
+                self._logger.warn('Failed to load group %s: %s' % (groupId, group))
+                continue
+            members = group.get('9018', dict()).get('15002', dict()).get('9003', [])
+            groups.append(dict(id=device_key(gateway_id, groupId), name=group.get('9001', str(groupId)),
+                               devices=[device_key(gateway_id, member) for member in members], gateway=gateway_id))
+        return groups
+
+    async def _discover_gateways(self, gateways):
+        # Every gateway at once, an offline gateway does not hold up the others
+        return await asyncio.gather(*[asyncio.gather(self._discover_devices(gateway.id),
+                                                     self._discover_groups(gateway.id))
+                                      for gateway in gateways], return_exceptions=True)
+
     def loadDevices(self, startup=False):
-        gateway_ip = self._settings.get(["gateway_ip"])
-        security_code = self._settings.get(["security_code"])
-        if gateway_ip != "" and security_code != "":
-            self._logger.debug('load devices')
-            devices = self.run_gateway_get_request('15001')
-            if devices is None:
-                return
-            self.devices = []
-            for i in range(len(devices)):
-                dev = self.run_gateway_get_request(
-                    '15001/{}'.format(devices[i]))
-                if '3312' in dev:
-                    self.devices.append(dict(id=devices[i], name=dev['9001'], type="Outlet"))
-                elif '3311' in dev:  # Lights
-                    self.devices.append(dict(id=devices[i], name=dev['9001'], type="Light"))
-            if len(self.devices):
-                self.status = 'ok'
+        gateways = [gateway for gateway in self.gateways.values() if gateway.configured()]
+        if not len(gateways):
+            self._logger.warn("No security code or gateway ip")
+            self.save_settings()
+            return
+
+        self._logger.debug('load devices')
+        results = self.session.run(self._discover_gateways(gateways))
+
+        devices = []
+        groups = []
+        loaded = False
+        for gateway, result in zip(gateways, results):
+            found, foundGroups = (None, None) if isinstance(result, Exception) else result
+            # What an unreachable gateway had is kept until it answers again
+            if found is None:
+                self._logger.warn('Failed to load the devices of gateway %s: %s' % (gateway.id, result))
+                found = [dev for dev in self.devices if (dev.get('gateway') or DEFAULT_GATEWAY) == gateway.id]
             else:
-                self.status = 'no_devices'
+                loaded = True
+                gateway.status = 'ok' if len(found) else 'no_devices'
+            if foundGroups is None:
+                foundGroups = [group for group in self.groups
+                               if (group.get('gateway') or DEFAULT_GATEWAY) == gateway.id]
+            devices.extend(found)
+            groups.extend(foundGroups)
+        if not loaded:
+            return
+
+        self.devices = devices
+        self.groups = groups
+        self.devicesLoadedAt = time.time()
+        if len(self.devices):
+            self.status = 'ok'
         else:
-            self._logger.warn("No security code or gateway ip")
+            self.status = 'no_devices'
         self.save_settings()
 
+    def isInventoryExpired(self):
+        if self.devicesLoadedAt is None:
+            return True
+        return time.time() - self.devicesLoadedAt >= int(self._settings.get(['devices_ttl']))
+
+    def getDevices(self, refresh=False):
+        if refresh or self.isInventoryExpired():
+            self.loadDevices()
+        return self.devices
+
+    def invalidateDevices(self):
+        self.devicesLoadedAt = None
+
+    def resetAuth(self, gateway):
+        gateway.authAt = None
+        self.storeCredentials(gateway, None, None)
+
     def on_settings_save(self, data):
         # keyAsNumber = ['postponeDelay', 'stop_timer', 'connection_timer']
         # for key in data:
         #     if key in keyAsNumber:
         #         data[key] = int(data[key])
 
+        # Runtime state, never written to the settings file
+        data.pop('status', None)
+        data.pop('error_message', None)
+        if 'gateways' in data:
+            data['gateways'] = self.validGateways(data['gateways'])
+
+        gateways = self.gatewaySettings()
         octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
-        self.loadDevices()
+
+        # Only gateway changes need a rediscovery, timer or device changes keep the inventory
+        if gateways != self.gatewaySettings():
+            self.loadGateways()
+            self.invalidateDevices()
+            self.loadDevices()
+        else:
+            self.tuneSessions()
+        self.reloadSelectedDevices()
+
+    def on_settings_load(self):
+        data = octoprint.plugin.SettingsPlugin.on_settings_load(self)
+        data['status'] = self.status
+        data['error_message'] = self.error_message
+        return data
+
+    def on_shutdown(self):
+        if self.states is not None:
+            self.save_settings()
+        if self.writer is not None:
+            self.writer.flush()
+        if self.history is not None:
+            self.history.flush()
+        if self.stream is not None:
+            self.stream.close()
+        if self.mqttQueue is not None:
+            self.mqttQueue.shutdown()
+        if self.scheduler is not None:
+            self.scheduler.shutdown()
+        if self.jobs is not None:
+            self.jobs.shutdown()
+        if self.states is not None:
+            self.states.stop()
+        # The other sessions run on the loop of the default one
+        for gateway in self.gateways.values():
+            if gateway.session is not self.session:
+                gateway.session.close()
+        if self.session is not None:
+            self.session.close()
 
     def on_after_startup(self):
 
@@ -261,42 +588,102 @@ class IkeaTradfriPlugin(
 
         if self.baseTopic:
             self._logger.info('Enable MQTT')
+            prefix = self.mqttPrefix = '%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/')
+            self.mqttRoutes = {
+                prefix + 'turnOn': functools.partial(self.mqttCommand, 'turnOn'),
+                prefix + 'turnOff': functools.partial(self.mqttCommand, 'turnOff'),
+                prefix + 'turnOnSet': functools.partial(self.mqttSetCommand, 'turnOn'),
+                prefix + 'turnOffSet': functools.partial(self.mqttSetCommand, 'turnOff'),
+                prefix + 'state': self.mqttState,
+                prefix + 'setLight': self.mqttSetLight,
+            }
             self.mqtt_subscribe('%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/#'), self.on_mqtt_sub)
-
+            self.statePublisher.start()
+            if int(self._settings.get(['metrics_mqtt_interval'])) > 0:
+                self.scheduler.schedule('metrics', int(self._settings.get(['metrics_mqtt_interval'])),
+                                        self.publishMetrics)
+
+        # The gateway is only contacted in the background, a slow or unreachable gateway does not hold the startup
+        self.startedAt = time.perf_counter()
+        self.firstStatePending = True
+        self.jobs.submit('startup', 'startup', self.startupSync)
+        self.scheduler.schedule('history_compact', 60, self.compactHistory)
+
+    def startupSync(self):
+        self._send_message("startup", dict(step='discovery'))
         self.loadDevices(startup=True)
-        self.getStateData()
+
+        self._send_message("startup", dict(step='states', status=self.status))
+        records = list(self.registry.records())
+        states = self.session.run(self._fetch_states(records)) if len(records) else dict()
+        self.watchDevices()
+        self.pushNavbar()
+
+        failed = [device_id for device_id, item in states.items() if item['error'] is not None]
+        self._send_message("startup", dict(step='done', status=self.status, failed=failed))
+        self.metrics.observe('startup', time.perf_counter() - self.startedAt)
 
     def on_mqtt_sub(self, topic, message, retain=None, qos=None, *args, **kwargs):
         self._logger.debug("Receive mqtt message %s" % (topic))
-        if self.baseTopic is None:
+        route = self.mqttRoutes.get(topic)
+        if route is None:
             return
 
-        if topic == '%s%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/', 'turnOn'):
-            self._logger.info('MQTT request turn on : %s', message)
-            payload = json.loads(message)
-            if 'id' in payload:
-                dev = self.getDeviceFromId(payload['id'])
-                if dev is not None:
-                    self._logger.info('MQTT turn on : %s', dev['name'])
-                    self.turnOn(dev)
-
-
-        elif topic == '%s%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/', 'turnOff'):
-            self._logger.info('MQTT request turn off : %s', message)
-            payload = json.loads(message)
-            if 'id' in payload:
-                dev = self.getDeviceFromId(payload['id'])
-                if dev is not None:
-                    self._logger.info('MQTT turn off : %s', dev['name'])
-                    self.turnOff(dev)
-        elif topic == '%s%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/', 'state'):
-            self.getStateData()
-
-    def mqtt_publish_ikea(self, topic, payload):
-        if self.baseTopic is None:
+        # Runs on the MQTT client thread: only decodes and queues, the MQTT workers do the rest
+        try:
+            route(message)
+        except (TypeError, ValueError, AttributeError) as e:
+            self._logger.warn('MQTT invalid message on %s : %s (%s)' % (topic, message, e))
+
+    def mqttCommand(self, command, message):
+        self._logger.info('MQTT request %s : %s', command, message)
+        payload = json.loads(message)
+        if 'id' in payload:
+            dev = self.getDeviceFromId(payload['id'])
+            if dev is not None:
+                # Latest wins: a turnOff queued behind a waiting turnOn of the same device replaces it
+                self.mqttQueue.put(('device', dev['id']), self.runCommand, (dev, command))
+
+    def mqttSetCommand(self, command, message):
+        self._logger.info('MQTT request %s set : %s', command, message)
+        payload = json.loads(message)
+        if 'set' in payload:
+            deviceSet = self.getDeviceSet(payload['set'])
+            if deviceSet is not None:
+                self.mqttQueue.put(('set', deviceSet['name']), self.runSetCommand, (deviceSet, command))
+
+    def mqttState(self, message):
+        # A burst of requests publishes the states once
+        self.mqttQueue.put(('state',), self.getStateData, (True,))
+
+    def mqttSetLight(self, message):
+        payload = json.loads(message)
+        if 'id' in payload:
+            values = dict((key, payload[key]) for key in LIGHT_SETTINGS if key in payload)
+            device_id = parse_key(payload['id'])
+            self.mqttQueue.put(('light', device_id), self.mqttApplyLight, (device_id, values),
+                               merge=lambda old, new: (new[0], dict(old[1], **new[1])))
+
+    def mqttApplyLight(self, device_id, values):
+        try:
+            self.setLight(device_id, values, 'mqtt')
+        except (TypeError, ValueError) as e:
+            self._logger.warn('MQTT invalid light update %s : %s' % (values, e))
+
+    def runCommand(self, device, command):
+        # The MQTT worker waits for the gateway, messages for this device coalesce meanwhile
+        job = self.queueCommand(device, command, 'mqtt')
+        self.jobs.wait(job['id'], timeout=60)
+
+    def runSetCommand(self, deviceSet, command):
+        job = self.queueSetCommand(deviceSet, command, 'mqtt')
+        self.jobs.wait(job['id'], timeout=60)
+
+    def mqtt_publish_ikea(self, topic, payload, retained=False):
+        if self.mqttPrefix is None:
             return
 
-        self.mqtt_publish('%s%s%s' % (self.baseTopic, 'plugin/ikea_tradfri/', topic), payload)
+        self.mqtt_publish(self.mqttPrefix + topic, payload, retained=retained)
 
 
     # ~~ SettingsPlugin mixin
@@ -306,14 +693,43 @@ class IkeaTradfriPlugin(
             # put your plugin's default settings here
             security_code="",
             gateway_ip="",
-            psk="",
+            gateways=[],
+            gateway_credentials=dict(),
             selected_devices=[],
-            status='',
-            error_message='',
             devices=[],
+            groups=[],
+            states=[],
+            device_sets=[],
+            max_inflight_requests=4,
+            gateway_result_ttl=0,
+            state_poll_interval=30,
+            state_stream_timeout=25,
+            # Each waiting navbar holds one of OctoPrint's few web server threads, see the README
+            state_stream_clients=2,
+            job_workers=4,
+            devices_ttl=3600,
+            light_update_rate=5,
+            mqtt_queue_size=100,
+            mqtt_workers=2,
+            mqtt_heartbeat_interval=0,
+            history_flush_delay=10,
+            cooldown_interval=5,
+            cooldown_max_sleep=120,
+            cooldown_ambient=20,
+            history_retention_days=365,
+            settings_save_delay=5,
+            gateway_get_timeout=5,
+            gateway_put_timeout=10,
+            gateway_retries=2,
+            breaker_threshold=5,
+            breaker_reset_timeout=30,
+            metrics_mqtt_interval=0,
             config_version_key=1
         )
 
+    def get_settings_restricted_paths(self):
+        return dict(never=[["gateway_credentials"]])
+
     # ~~ TemplatePlugin mixin
 
     def get_template_configs(self):
@@ -399,30 +815,49 @@ class IkeaTradfriPlugin(
         )
 
     def planStop(self, dev, force_postpone=False):
-        if dev['id'] in self.stopTimer and self.stopTimer[dev['id']] is not None:
-            self.stopTimer[dev['id']].cancel()
-            self.stopTimer[dev['id']] = None
-
-        if dev['id'] in self.stopCooldown and self.stopCooldown[dev['id']] is not None:
-            self.stopCooldown[dev['id']].cancel()
-            self.stopCooldown[dev['id']] = None
-
         if dev['turn_off_mode'] == "time" or force_postpone:
+            self.stopCooldown[dev['id']] = None
+            self.cooldownEta.pop(dev['id'], None)
             delay = int(dev['stop_timer'])
             if force_postpone:
                 delay = int(dev['postpone_delay'])
 
             self.planStopTimeMode(dev, delay)
         else:
+            self.scheduler.cancel(('stop', dev['id']))
+            self.shutdownAt[dev['id']] = None
             self.planStopCooldown(dev)
 
+    def cancelStop(self, device_id):
+        self.shutdownAt[device_id] = None
+        self.scheduler.cancel(('stop', device_id))
+        self.stopCooldown[device_id] = None
+        self.cooldownEta.pop(device_id, None)
+
     def planStopCooldown(self, dev):
+        if not any(waiting is not None for waiting in self.stopCooldown.values()):
+            # Samples of a previous cooldown would bend the fit
+            self.cooldown.reset()
+        self.stopCooldown[dev['id']] = dev
+        if not self.scheduler.pending('cooldown'):
+            self.scheduler.schedule('cooldown', 0, self.cooldownTick)
+        self.pushSidebar()
+
+    def cooldownTick(self):
+        waiting = [dev for dev in self.stopCooldown.values() if dev is not None]
+        if not len(waiting):
+            return
 
-        hotend_request = int(dev['cooldown_hotend'])
-        bed_request = int(dev['cooldown_bed'])
+        # One temperature sample for every device waiting on the cooldown
+        temps = self._printer.get_current_temperatures()
+        now = time.time()
+        self.cooldown.add(now, temps)
 
-        def wrapper():
-            temps = self._printer.get_current_temperatures()
+        interval = float(self._settings.get(['cooldown_interval']))
+        delay = float(self._settings.get(['cooldown_max_sleep']))
+        for dev in waiting:
+            hotend_request = int(dev['cooldown_hotend'])
+            bed_request = int(dev['cooldown_bed'])
 
             ready_for_stop = True
 
@@ -432,38 +867,39 @@ class IkeaTradfriPlugin(
                 ready_for_stop = False
 
             if ready_for_stop:
-                self.turnOff(dev)
                 self.stopCooldown[dev['id']] = None
-            else:
-                self.stopCooldown[dev['id']] = threading.Timer(5, wrapper)
-                self.stopCooldown[dev['id']].start()
-            self._send_message("sidebar", self.sidebarInfoData())
+                self.cooldownEta.pop(dev['id'], None)
+                self.queueCommand(dev, 'turnOff', 'cooldown')
+                continue
 
-        self.stopCooldown[dev['id']] = threading.Timer(5, wrapper)
-        self.stopCooldown[dev['id']].start()
-        self._send_message("sidebar", self.sidebarInfoData())
+            # Both sensors must be down, the device waits for the later one
+            etas = []
+            if bed_request > -1:
+                etas.append(self.cooldown.eta('bed', bed_request, now))
+            if hotend_request > -1 and 'tool0' in temps:
+                etas.append(self.cooldown.eta('tool0', hotend_request, now))
+            eta = None if None in etas or not etas else max(etas)
+            self.cooldownEta[dev['id']] = eta
+
+            # Until the curve is fitted sample every interval, then sleep most of the way to the predicted
+            # crossing: the next samples correct the prediction as it gets closer.
+            if eta is None:
+                delay = min(delay, interval)
+            else:
+                delay = min(delay, max(interval, (eta - now) * 0.8))
 
+        if any(dev is not None for dev in self.stopCooldown.values()):
+            self.scheduler.schedule('cooldown', delay, self.cooldownTick)
+        self.pushSidebar()
 
     def planStopTimeMode(self, dev, delay):
-        now = math.ceil(time.time())
-
-
-        if self.shutdownAt[dev['id']] is not None:
-            self.shutdownAt[dev['id']] += delay
-        else:
-            self.shutdownAt[dev['id']] = now + delay
-        stopIn = (self.shutdownAt[dev['id']] - now)
+        deadline = self.scheduler.postpone_or_schedule(('stop', dev['id']), delay, self.queueCommand, dev, 'turnOff',
+                                                       'timer')
+        self.shutdownAt[dev['id']] = math.ceil(deadline)
+        stopIn = (self.shutdownAt[dev['id']] - math.ceil(time.time()))
         self._logger.info("Schedule turn off in %d s" % stopIn)
 
-        def wrapper():
-            self.turnOff(dev)
-
-        self.stopTimer[dev['id']] = threading.Timer(stopIn, wrapper)
-        self.stopTimer[dev['id']].start()
-
-        self._send_message("sidebar", self.sidebarInfoData())
-
-
+        self.pushSidebar()
 
     def connect_palette2(self):
         try:
@@ -472,12 +908,15 @@ class IkeaTradfriPlugin(
         except:
             self._logger.error('Failed to connect to palette')
 
-    def turnOn(self, device):
-        if 'type' not in device or device['type'] == 'Outlet':
-            self.turnOnOutlet(device['id'])
-        else:
-            self.turnOnLight(device['id'])
+    def turnOn(self, device, source='api'):
+        self.switchDevice(device, 1, source)
+
+        self.planConnect(device)
 
+        self.pushSidebar()
+        self.pushNavbar()
+
+    def planConnect(self, device):
         connection_timer = int(device['connection_timer'])
 
         def connect():
@@ -487,82 +926,223 @@ class IkeaTradfriPlugin(
                 self._printer.connect()
 
         if connection_timer >= -1:
-            c = threading.Timer(connection_timer, connect)
-            c.start()
-
-        self._send_message("sidebar", self.sidebarInfoData())
-        self._send_message("navbar", self.navbarInfoData())
-
-    def turnOnOutlet(self, deviceId):
-        self.run_gateway_put_request(
-            '/15001/{}'.format(deviceId), '{ "3312": [{ "5850": 1 }] }')
+            self.scheduler.schedule(('connect', device['id']), connection_timer, connect)
 
-    def turnOnLight(self, deviceId):
-        self.run_gateway_put_request(
-            '/15001/{}'.format(deviceId), '{ "3311": [{ "5850": 1 }] }')
+    def switchDevice(self, device, state, source='api'):
+        record = self.registry.get(device['id']) or DeviceRecord(device)
+        self.expectChange([record.id], source)
+        try:
+            if self.run_gateway_put_request(record.path, record.payloads[state], record.gateway) is None:
+                raise CommandFailed('The gateway did not switch %s' % record.id)
+            self.states.set(record.id, state == 1)
+        finally:
+            self.settleChange([record.id])
+
+    def expectChange(self, device_ids, source):
+        # The change may also be reported first by the observation of the device
+        for device_id in device_ids:
+            self.sources[device_id] = source
+
+    def settleChange(self, device_ids):
+        # Left when the device already was in that state, its next change is not ours
+        for device_id in device_ids:
+            self.sources.pop(device_id, None)
+
+    def turnOff(self, device, source='api'):
+        if not self.prepareTurnOff([device]):
+            return
 
-    def turnOff(self, device):
-        self.shutdownAt[device['id']] = None
-        if device['id'] in self.stopTimer and self.stopTimer[device['id']] is not None:
-            self.stopTimer[device['id']].cancel()
-            self.stopTimer[device['id']] = None
-        if device['id'] in self.stopCooldown and self.stopCooldown[device['id']] is not None:
-            self.stopCooldown[device['id']].cancel()
-            self.stopCooldown[device['id']] = None
+        self._logger.debug('stop')
+        self.switchDevice(device, 0, source)
+        self.pushNavbar()
 
+    def prepareTurnOff(self, devices):
+        for device in devices:
+            self.cancelStop(device['id'])
 
-        self._send_message("sidebar", self.sidebarInfoData())
+        self.pushSidebar()
         if self._printer.is_printing():
             self._logger.warn("Don't turn off outlet because printer is printing !")
-            return
+            return False
         elif self._printer.is_pausing() or self._printer.is_paused():
             self._logger.warn("Don't turn off outlet because printer is in pause !")
-            return
+            return False
         elif self._printer.is_cancelling():
             self._logger.warn("Don't turn off outlet because printer is cancelling !")
-            return
+            return False
 
-        if not f('connect_palette2' in device and device['connect_palette2']):
-            self._printer.disconnect()
+        for device in devices:
+            if not ('connect_palette2' in device and device['connect_palette2']):
+                self._printer.disconnect()
+        return True
 
-        self._logger.debug('stop')
-        if 'type' not in device or device['type'] == 'Outlet':
-            self.turnOffOutlet(device['id'])
-        else:
-            self.turnOffLight(device['id'])
-        self._send_message("navbar", self.navbarInfoData())
+    def getDeviceSet(self, name):
+        for deviceSet in self._settings.get(['device_sets']):
+            if deviceSet['name'] == name:
+                return deviceSet
+        return None
 
-    def turnOffOutlet(self, deviceId):
-        self.run_gateway_put_request('/15001/{}'.format(deviceId), '{ "3312": [{ "5850": 0 }] }')
+    def getDeviceSetDevices(self, deviceSet):
+        devices = [self.getDeviceFromId(device_id) for device_id in deviceSet['devices']]
+        return [device for device in devices if device is not None]
+
+    def getMatchingGroup(self, devices):
+        # A gateway group only replaces the per device commands when it switches exactly these devices
+        known = set(dev['id'] for dev in self.devices)
+        wanted = set(device['id'] for device in devices)
+        for group in self.groups:
+            if set(device_id for device_id in group['devices'] if device_id in known) == wanted:
+                return group
+        return None
 
-    def turnOffLight(self, deviceId):
-        self.run_gateway_put_request(
-            '/15001/{}'.format(deviceId), '{ "3311": [{ "5850": 0 }] }')
+    def switchDevices(self, devices, state, source='api'):
+        # Returns the ids of the devices the gateway did not switch
+        device_ids = [device['id'] for device in devices]
+        self.expectChange(device_ids, source)
+        try:
+            group = self.getMatchingGroup(devices)
+            if group is None:
+                return self.session.run(self._switchDevices(devices, state))
+            self._logger.debug('switch group %s' % group['name'])
+            if self.run_gateway_put_request('/15004/{}'.format(native_id(group['id'])), {"5850": state},
+                                            group.get('gateway') or DEFAULT_GATEWAY) is None:
+                return device_ids
+            for device in devices:
+                self.states.set(device['id'], state == 1)
+            return []
+        finally:
+            self.settleChange(device_ids)
+
+    async def _switchDevices(self, devices, state):
+        records = [self.registry.get(device['id']) or DeviceRecord(device) for device in devices]
+        results = await asyncio.gather(*[self._run_gateway_put_request(record.path, record.payloads[state],
+                                                                       record.gateway)
+                                         for record in records], return_exceptions=True)
+        failed = []
+        for record, result in zip(records, results):
+            if result is not None and not isinstance(result, Exception):
+                self.states.set(record.id, state == 1)
+            else:
+                failed.append(record.id)
+        return failed
+
+    def turnOnSet(self, deviceSet, source='api'):
+        devices = self.getDeviceSetDevices(deviceSet)
+        failed = self.switchDevices(devices, 1, source)
+
+        for device in devices:
+            if device['id'] not in failed:
+                self.planConnect(device)
+
+        self.pushSidebar()
+        self.pushNavbar()
+        if failed:
+            raise CommandFailed('The gateway did not switch %s' % ', '.join(str(device_id) for device_id in failed))
+
+    def turnOffSet(self, deviceSet, source='api'):
+        devices = self.getDeviceSetDevices(deviceSet)
+        if not self.prepareTurnOff(devices):
+            return
+
+        failed = self.switchDevices(devices, 0, source)
+        self.pushNavbar()
+        if failed:
+            raise CommandFailed('The gateway did not switch %s' % ', '.join(str(device_id) for device_id in failed))
+
+    def queueCommand(self, device, command, source='api'):
+        if command == 'turnOn':
+            return self.jobs.submit(device['id'], command, self.turnOn, device, source)
+        return self.jobs.submit(device['id'], command, self.turnOff, device, source)
+
+    def queueSetCommand(self, deviceSet, command, source='api'):
+        key = 'set/%s' % deviceSet['name']
+        # Also holds the member devices: their own commands do not run alongside or overtake it
+        keys = [key] + [device['id'] for device in self.getDeviceSetDevices(deviceSet)]
+        if command == 'turnOn':
+            return self.jobs.submit_for(keys, key, command, self.turnOnSet, deviceSet, source)
+        return self.jobs.submit_for(keys, key, command, self.turnOffSet, deviceSet, source)
+
+    def setLight(self, device_id, values, source='api'):
+        record = self.registry.get(device_id)
+        if record is None or record.code != "3311":
+            raise ValueError('%s is not a selected light' % device_id)
+        # Coalesced updates are sent at once, the latest source is recorded
+        self.lightSources[device_id] = source
+        return self.lights.update(device_id, values)
+
+    def queueLight(self, device_id):
+        return self.jobs.submit(device_id, 'setLight', self.applyLight, device_id)
+
+    def applyLight(self, device_id):
+        item = self.lights.take(device_id)
+        record = self.registry.get(device_id)
+        if not item or record is None:
+            return
+
+        self.expectChange([device_id], self.lightSources.pop(device_id, 'api'))
+        try:
+            if self.run_gateway_put_request(record.path, {record.code: [item]}, record.gateway) is None:
+                raise CommandFailed('The gateway did not update light %s' % device_id)
+            # The gateway turns a light on when it is dimmed above 0 and off at 0
+            if '5850' in item:
+                self.states.set(device_id, item['5850'] == 1)
+            elif '5851' in item:
+                self.states.set(device_id, item['5851'] > 0)
+        finally:
+            self.settleChange([device_id])
+
+    def on_job_done(self, job):
+        self._send_message("job", job)
+        self.mqtt_publish_ikea('job/%s' % job['id'], job)
 
     def get_api_commands(self):
         return dict(
-            turnOn=[], turnOff=[], checkStatus=[]
+            turnOn=[], turnOff=[], checkStatus=[], refreshDevices=[], getStates=[], turnOnSet=["set"],
+            turnOffSet=["set"], setLight=["id"]
         )
 
+    def on_api_get(self, request):
+        return flask.jsonify(gateway=self.session.stats, push=self.push.stats)
+
+    def metricsData(self):
+        return dict(
+            histograms=self.metrics.snapshot(),
+            gateway=self.session.stats,
+            push=self.push.stats,
+            lights=self.lights.stats,
+            mqtt=dict(self.mqttQueue.stats, depth=self.mqttQueue.depth),
+            mqtt_states=self.statePublisher.stats,
+            history=self.history.stats,
+            cooldown=self.cooldown.stats,
+            stream=dict(self.stream.stats, version=self.stream.version, waiting=self.stream.waiting),
+            breaker=dict(self.session.breaker.info(), **self.session.breaker.stats),
+            gateways=dict((gateway.id, dict(gateway.info(), requests=gateway.session.stats,
+                                            breaker=gateway.session.breaker.stats))
+                          for gateway in self.gateways.values())
+        )
+
+    def publishMetrics(self):
+        self.mqtt_publish_ikea('metrics', self.metricsData())
+        interval = int(self._settings.get(['metrics_mqtt_interval']))
+        if interval > 0:
+            self.scheduler.schedule('metrics', interval, self.publishMetrics)
+
     def getDeviceFromId(self, id):
-        selected_devices = self._settings.get(['selected_devices']);
-        device = None
-        for dev in selected_devices:
-            if dev['id'] == id:
-                return dev
-        return None
+        return self.registry.device(id)
 
     def on_api_command(self, command, data):
         import flask
         if command == "turnOn":
             if 'dev' in data:
-                self.turnOn(data['dev'])
+                return flask.jsonify(job=self.queueCommand(data['dev'], 'turnOn'))
             elif 'ip' in data:  # Octopod ?
-                device = self.getDeviceFromId(int(data['ip']))
+                device = self.getDeviceFromId(parse_key(data['ip']))
                 if device is None:
                     pass
                 else:
-                    self.turnOn(device)
+                    # Octopod expects the resulting state in the response
+                    job = self.queueCommand(device, 'turnOn')
+                    self.jobs.wait(job['id'], timeout=60)
                     status = self.getStateDataById(device['id'])
                     res = dict(ip=str(device['id']), currentState=("on" if status['state'] else "off"))
                     return flask.jsonify(res)
@@ -570,13 +1150,14 @@ class IkeaTradfriPlugin(
                 self._logger.warn('turn on without device data')
         elif command == "turnOff":
             if 'dev' in data:
-                self.turnOff(data['dev'])
+                return flask.jsonify(job=self.queueCommand(data['dev'], 'turnOff'))
             elif 'ip' in data:  # Octopod ?
-                device = self.getDeviceFromId(int(data['ip']))
+                device = self.getDeviceFromId(parse_key(data['ip']))
                 if device is None:
                     pass
                 else:
-                    self.turnOff(device)
+                    job = self.queueCommand(device, 'turnOff')
+                    self.jobs.wait(job['id'], timeout=60)
                     status = self.getStateDataById(device['id'])
                     res = dict(ip=str(device['id']), currentState=("on" if status['state'] else "off"))
                     return flask.jsonify(res)
@@ -588,7 +1169,7 @@ class IkeaTradfriPlugin(
                 status = self.getStateDataById(data["dev"]['id'])
                 return flask.jsonify(status)
             elif 'ip' in data:  # Octopod ?
-                device = self.getDeviceFromId(int(data['ip']))
+                device = self.getDeviceFromId(parse_key(data['ip']))
                 if device is None:
                     pass
                 else:
@@ -597,6 +1178,27 @@ class IkeaTradfriPlugin(
                     return flask.jsonify(res)
             else:
                 self._logger.warn('checkStatus without device data')
+        elif command == "refreshDevices":
+            return flask.jsonify(self.getDevices(refresh=True))
+        elif command in ("turnOnSet", "turnOffSet"):
+            deviceSet = self.getDeviceSet(data['set'])
+            if deviceSet is None:
+                return flask.make_response("Unknown device set.", 404)
+            job = self.queueSetCommand(deviceSet, 'turnOn' if command == "turnOnSet" else 'turnOff')
+            return flask.jsonify(job=job)
+        elif command == "getStates":
+            ids = self.parseDeviceIds(data.get('ids'))
+            if ids is None:
+                return flask.make_response("Expected a list of device ids or \"all\".", 400)
+            # Keyed by device, numbers and prefixed ids mixed: not sortable by jsonify
+            return flask.make_response(json.dumps(dict(states=self.getStates(ids))), 200)
+        elif command == "setLight":
+            values = dict((key, data[key]) for key in LIGHT_SETTINGS if key in data)
+            try:
+                pending = self.setLight(parse_key(data['id']), values)
+            except (TypeError, ValueError) as e:
+                return flask.make_response(str(e), 400)
+            return flask.jsonify(pending=pending)
 
     def get_additional_permissions(self):
         return [
@@ -612,13 +1214,83 @@ class IkeaTradfriPlugin(
         data = self.navbarInfoData()
         return flask.make_response(json.dumps(data), 200)
 
+    @octoprint.plugin.BlueprintPlugin.route("/states", methods=["GET"])
+    def listStates(self):
+        ids = self.parseDeviceIds(flask.request.values.get('ids'))
+        if ids is None:
+            return flask.make_response("Expected a list of device ids or \"all\".", 400)
+        data = dict(states=self.getStates(ids))
+        return flask.make_response(json.dumps(data), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/jobs/<job_id>", methods=["GET"])
+    def jobStatus(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return flask.make_response("Unknown job.", 404)
+        return flask.make_response(json.dumps(job), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def metricsInfo(self):
+        if flask.request.values.get('format') == 'prometheus':
+            # Totals over the gateways, the JSON metrics have them per gateway
+            requests = collections.Counter()
+            breakers = collections.Counter()
+            for gateway in self.gateways.values():
+                requests.update(gateway.session.stats)
+                breakers.update(gateway.session.breaker.stats)
+            text = self.metrics.prometheus(
+                dict(gateway=requests, push=self.push.stats, lights=self.lights.stats,
+                     stream=self.stream.stats, breaker=breakers, mqtt=self.mqttQueue.stats,
+                     mqtt_states=self.statePublisher.stats, history=self.history.stats),
+                dict(breaker_open=sum(gateway.session.breaker.state != CLOSED for gateway in self.gateways.values()),
+                     stream_waiting=self.stream.waiting, mqtt_queue_depth=self.mqttQueue.depth))
+            return flask.make_response(text, 200, {'Content-Type': 'text/plain; version=0.0.4'})
+        return flask.make_response(json.dumps(self.metricsData()), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/states/stream", methods=["GET"])
+    def streamStates(self):
+        # Long-poll on the state cache: answers at once with the states changed since version `since` (all of them
+        # without `since`), otherwise as soon as one changes or after `timeout` seconds. Each waiting client holds a
+        # server thread, beyond state_stream_clients they are told to come back later instead.
+        since = flask.request.values.get('since', type=int)
+        timeout = min(flask.request.values.get('timeout', 0, type=float),
+                      float(self._settings.get(['state_stream_timeout'])))
+        if timeout > 0 and self.stream.waiting >= int(self._settings.get(['state_stream_clients'])):
+            data = dict(self.stream.changes(since), retry=timeout)
+        else:
+            data = self.stream.wait(since, timeout)
+        return flask.make_response(json.dumps(data), 200, {'Content-Type': 'application/json'})
+
+    @octoprint.plugin.BlueprintPlugin.route("/history", methods=["GET"])
+    def historyEvents(self):
+        # State transitions within [start, end) (timestamps), optionally of one device, oldest first
+        values = flask.request.values
+        try:
+            device_id = parse_key(values['device']) if values.get('device') else None
+        except ValueError:
+            return flask.make_response("Unknown device id.", 400)
+        events = self.history.events(values.get('start', type=float), values.get('end', type=float), device_id,
+                                     values.get('limit', 1000, type=int))
+        return flask.make_response(json.dumps(dict(events=events)), 200, {'Content-Type': 'application/json'})
+
+    @octoprint.plugin.BlueprintPlugin.route("/history/ontime", methods=["GET"])
+    def historyOnTime(self):
+        # Seconds each device was on per local day within [start, end), the last 7 days by default
+        end = flask.request.values.get('end', time.time(), type=float)
+        start = flask.request.values.get('start', end - 7 * 86400, type=float)
+        data = dict(start=start, end=end, devices=self.history.onTime(start, end))
+        return flask.make_response(json.dumps(data), 200, {'Content-Type': 'application/json'})
+
+    def compactHistory(self):
+        # The compaction rewrites the file, off the scheduler thread
+        self.jobs.submit('history', 'compactHistory', self.history.compact)
+        self.scheduler.schedule('history_compact', 86400, self.compactHistory)
+
     ##Sidebar
 
     def sidebarInfoData(self):
-        # TODO : info stop cooldown
-        selected_devices = self._settings.get(['selected_devices'])
         cooldown_wait = dict()
-        for dev in selected_devices:
+        for dev in self.registry.devices:
             if dev['id'] not in self.shutdownAt:
                 self.shutdownAt[dev['id']] = None
             if dev['turn_off_mode'] == "cooldown":
@@ -629,7 +1301,11 @@ class IkeaTradfriPlugin(
 
         return dict(
             shutdownAt=self.shutdownAt,
-            cooldown_wait=cooldown_wait
+            cooldown_wait=cooldown_wait,
+            cooldownAt=dict((device_id, math.ceil(eta)) for device_id, eta in self.cooldownEta.items()
+                            if eta is not None),
+            # Keyed by id: a removed gateway is a removed key, which makes the push channel send the full payload
+            gateways=dict((gateway.id, gateway.info()) for gateway in self.gateways.values())
         )
 
     @octoprint.plugin.BlueprintPlugin.route("/sidebar/info", methods=["GET"])
@@ -642,36 +1318,30 @@ class IkeaTradfriPlugin(
         dev = flask.request.json['dev']
         self.planStop(dev, True)
 
-        self._send_message("sidebar", self.sidebarInfoData())
+        self.pushSidebar()
 
         return self.sidebarInfo()
 
     @octoprint.plugin.BlueprintPlugin.route("/sidebar/cancelShutdown", methods=["POST"])
     def sidebarCancelShutdown(self):
         device = flask.request.json['dev']
-        if device['id'] in self.stopTimer and self.stopTimer[device['id']] is not None:
-            self.shutdownAt[device['id']] = None
-            self.stopTimer[device['id']].cancel()
-            self.stopTimer[device['id']] = None
-        if device['id'] in self.stopCooldown and self.stopCooldown[device['id']] is not None:
-            self.stopCooldown[device['id']].cancel()
-            self.stopCooldown[device['id']] = None
-        self._send_message("sidebar", self.sidebarInfoData())
+        self.cancelStop(device['id'])
+        self.pushSidebar()
         return self.sidebarInfo()
 
     @octoprint.plugin.BlueprintPlugin.route("/sidebar/shutdownNow", methods=["POST"])
     def sidebarShutdownNow(self):
         device = flask.request.json['dev']
-        self.turnOff(device)
-        self._send_message("sidebar", self.sidebarInfoData())
+        # Queued behind the other commands of the device
+        self.queueCommand(device, 'turnOff')
+        self.pushSidebar()
         return self.sidebarInfo()
 
     ### Wizard
     def is_wizard_required(self):
         gateway_ip = self._settings.get(["gateway_ip"])
         security_code = self._settings.get(["security_code"])
-        selected_devices = self._settings.get(['selected_devices'])
-        return gateway_ip == "" or security_code == "" or len(selected_devices) > 0
+        return gateway_ip == "" or security_code == "" or len(self.registry.devices) > 0
 
     def get_wizard_version(self):
         return 1
@@ -684,8 +1354,9 @@ class IkeaTradfriPlugin(
 
         dev = dict(
             name="Printer",
-            id=selected_outlet,
+            id=parse_key(selected_outlet),
             type="Outlet",
+            gateway=DEFAULT_GATEWAY,
             connection_timer=5,
             stop_timer=30,
             postpone_delay=30,
@@ -698,8 +1369,8 @@ class IkeaTradfriPlugin(
             nav_name=False,
             nav_icon=True
         )
-        self._settings.set(['selected_devices'], [dev])
-        self._settings.save()
+        self.writer.set(['selected_devices'], [dev])
+        self.reloadSelectedDevices()
 
         return flask.make_response("OK", 200)
 
@@ -710,23 +1381,22 @@ class IkeaTradfriPlugin(
         securityCode = flask.request.json['securityCode']
         gateway = flask.request.json['gateway']
 
-        if self.psk is not None:
-            global userId
-            userId = str(uuid.uuid1())[:8]
-            self.psk = None
+        self.resetAuth(self.getGateway(DEFAULT_GATEWAY))
 
+        identity = str(uuid.uuid1())[:8]
+        psk = None
         try:
-            psk = self.pool.submit(asyncio.run, self._auth(gateway_ip=gateway, security_code=securityCode)).result(
-                timeout=30)
+            psk = self.session.run(self._auth(gateway_ip=gateway, security_code=securityCode, identity=identity),
+                                   timeout=AUTH_TIMEOUT + 5)
         except Exception as e:
             self._logger.warn("wizzard : Error on try auth")
-        else:
-            self.psk = psk
 
-        if self.psk is not None:
-            self._settings.set(['security_code'], securityCode)
-            self._settings.set(['gateway_ip'], gateway)
-            self._settings.save()
+        if psk is not None:
+            self.writer.set(['security_code'], securityCode)
+            self.writer.set(['gateway_ip'], gateway)
+            # Picks up the new address first, it would drop the new credentials otherwise
+            self.loadGateways()
+            self.storeCredentials(self.getGateway(DEFAULT_GATEWAY), identity, psk)
             self.loadDevices()
 
             devices = self._settings.get(['devices'])
@@ -737,7 +1407,8 @@ class IkeaTradfriPlugin(
 
     @octoprint.plugin.BlueprintPlugin.route("/devices", methods=["GET"])
     def listDevices(self):
-        self.loadDevices()
+        refresh = flask.request.values.get('refresh', '0').lower() in ('1', 'true', 'yes')
+        self.getDevices(refresh=refresh)
         return flask.make_response(json.dumps(self.devices, indent=4), 200)
 
     @octoprint.plugin.BlueprintPlugin.route("/device/save", methods=["POST"])
@@ -750,24 +1421,50 @@ class IkeaTradfriPlugin(
         for ikDev in self.devices:
             if ikDev['id'] == device['id']:
                 device['type'] = ikDev['type']
+                device['gateway'] = ikDev.get('gateway') or DEFAULT_GATEWAY
 
-        selected_devices = self._settings.get(['selected_devices'])
-        index = -1
-        for i in range(len(selected_devices)):
-            dev = selected_devices[i]
-            if dev['id'] == device['id']:
-                index = i
-                break
-        if index >= 0:
-            selected_devices[index] = device
-        else:
+        selected_devices = [device if dev['id'] == device['id'] else dev for dev in self.registry.devices]
+        if self.registry.get(device['id']) is None:
             selected_devices.append(device)
 
-        self._settings.set(['selected_devices'], selected_devices)
-        self._settings.save()
+        self.writer.set(['selected_devices'], selected_devices)
+        self.reloadSelectedDevices()
 
         return flask.make_response(json.dumps(selected_devices, indent=4), 200)
 
+    @octoprint.plugin.BlueprintPlugin.route("/groups", methods=["GET"])
+    def listGroups(self):
+        data = dict(groups=self.groups, device_sets=self._settings.get(['device_sets']))
+        return flask.make_response(json.dumps(data, indent=4), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/device_set/save", methods=["POST"])
+    def saveDeviceSet(self):
+        if not "device_set" in flask.request.json:
+            return flask.make_response("Missing device set", 400)
+
+        deviceSet = flask.request.json['device_set']
+        if not deviceSet.get('name') or not isinstance(deviceSet.get('devices'), list):
+            return flask.make_response("Expected a name and a list of devices.", 400)
+
+        device_sets = [s for s in self._settings.get(['device_sets']) if s['name'] != deviceSet['name']]
+        device_sets.append(dict(name=deviceSet['name'], devices=deviceSet['devices']))
+
+        self.writer.set(['device_sets'], device_sets)
+
+        return flask.make_response(json.dumps(device_sets, indent=4), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/device_set/delete", methods=["POST"])
+    def deleteDeviceSet(self):
+        if not "name" in flask.request.json:
+            return flask.make_response("Missing device set", 400)
+
+        name = flask.request.json['name']
+        device_sets = [s for s in self._settings.get(['device_sets']) if s['name'] != name]
+
+        self.writer.set(['device_sets'], device_sets)
+
+        return flask.make_response(json.dumps(device_sets, indent=4), 200)
+
     @octoprint.plugin.BlueprintPlugin.route("/device/delete", methods=["POST"])
     def deleteDevice(self):
         if not "device_id" in flask.request.json:
@@ -775,64 +1472,129 @@ class IkeaTradfriPlugin(
 
         device_id = flask.request.json['device_id']
 
-        selected_devices = self._settings.get(['selected_devices'])
-        index = -1
-        for i in range(len(selected_devices)):
-            dev = selected_devices[i]
-            if dev['id'] == device_id:
-                index = i
-                break
-        if index >= 0:
-            selected_devices.remove(selected_devices[index])
+        selected_devices = [dev for dev in self.registry.devices if dev['id'] != device_id]
 
-        self._settings.set(['selected_devices'], selected_devices)
-        self._settings.save()
+        self.writer.set(['selected_devices'], selected_devices)
+        self.reloadSelectedDevices()
 
         return flask.make_response(json.dumps(selected_devices, indent=4), 200)
 
-    def getStateData(self):
+    def getStateData(self, publish=False):
         res = dict()
 
-        selected_devices = self._settings.get(['selected_devices'])
-        for device in selected_devices:
-            if 'id' not in device or device['id'] is None:
-                continue
-            res[device['id']] = self.getStateDataById(device['id'])
-            self.mqtt_publish_ikea('state/%s' % (device['id']), res[device['id']])
-
+        for record in self.registry.records():
+            res[record.id] = self.getStateDataById(record.id)
+            if publish:
+                self.statePublisher.device(record.id, res[record.id]['state'])
 
+        if publish:
+            self.statePublisher.publishSnapshot(force=True)
         return res
 
     def getStateDataById(self, device_id):
+        state = self.states.get(device_id)
+        if state is not None:
+            return dict(state=state)
 
-        device = self.getDeviceFromId(device_id)
-
-        code = "3312"
+        # Not followed (yet) by the state engine, ask the gateway
+        record = self.registry.get(device_id)
 
-        if device is None:
+        if record is None:
             return dict(state=False)
 
-        if device is not None and 'type' in device and device['type'] is not None and device['type'] != "Outlet":  # Light
-            code = "3311"
+        state = self.run_gateway_get_request(record.path, record.decode_state, record.gateway)
+        if state is None:
+            return dict(state=False)
 
-        data = self.run_gateway_get_request('/15001/{}'.format(device_id))
-        state = False
-        if code in data and len(data[code]) > 0 and "5850" in data[code][0]:
-            state = data[code][0]["5850"] == 1
+        self.states.set(device_id, state)
 
         res = dict(
             state=state
         )
         return res
 
-    def _send_message(self, msg_type, payload):
+    def getStates(self, ids='all'):
+        if ids == 'all':
+            ids = [record.id for record in self.registry.records()]
+
+        res = dict()
+        missing = []
+        for device_id in ids:
+            state = self.states.get(device_id)
+            record = self.registry.get(device_id)
+            if state is not None:
+                res[device_id] = dict(state=state, age=self.states.age(device_id), error=None)
+            elif record is None:
+                res[device_id] = dict(state=None, age=None, error='unknown_device')
+            else:
+                missing.append(record)
+
+        if len(missing):
+            res.update(self.session.run(self._fetch_states(missing)))
+        return res
+
+    async def _fetch_states(self, records):
+        results = await asyncio.gather(*[self._run_gateway_get_request(record.path, record.decode_state,
+                                                                       record.gateway)
+                                         for record in records], return_exceptions=True)
+        res = dict()
+        for record, state in zip(records, results):
+            if state is None or isinstance(state, Exception):
+                res[record.id] = dict(state=None, age=None, error='gateway_error')
+                continue
+            self.states.set(record.id, state)
+            res[record.id] = dict(state=state, age=0, error=None)
+        return res
+
+    def parseDeviceIds(self, ids):
+        if ids is None or ids == 'all':
+            return 'all'
+        if isinstance(ids, str):
+            ids = [device_id for device_id in ids.split(',') if device_id.strip()]
+        try:
+            return [parse_key(device_id) for device_id in ids]
+        except (TypeError, ValueError):
+            return None
+
+    def watchDevices(self):
+        return self.states.watch(list(self.registry.records()))
+
+    def reloadSelectedDevices(self):
+        self.registry.rebuild(self._settings.get(['selected_devices']))
+        return self.watchDevices()
+
+    def on_state_change(self, device_id, state):
+        if self.firstStatePending:
+            # startedAt is still needed by the startup sync
+            self.firstStatePending = False
+            self.metrics.observe('first_state', time.perf_counter() - self.startedAt)
+        self.statePublisher.device(device_id, state)
+        self.history.record(device_id, state, self.sources.get(device_id, 'external'))
+        self.pushNavbar()
+
+    def on_breaker_change(self, gateway_id, state):
+        self._logger.info('Circuit breaker of gateway %s %s' % (gateway_id, state))
+        self.pushSidebar()
+
+    def pushSidebar(self):
+        with self.metrics.timer('push_sidebar'):
+            self.push.push("sidebar", self.sidebarInfoData())
+
+    def pushNavbar(self):
+        # Built from the state cache only, a push never waits on the gateway
+        with self.metrics.timer('push_navbar'):
+            states = self.states.snapshot()
+            self.stream.update(states)
+            self.push.push("navbar", dict(state=states))
+
+    def _send_message(self, msg_type, payload, partial=False):
         self._logger.debug("send message type {}".format(msg_type))
         self._plugin_manager.send_plugin_message(
             self._identifier,
-            dict(type=msg_type, payload=payload))
+            dict(type=msg_type, payload=payload, partial=partial))
 
     def get_settings_version(self):
-        return 5
+        return 8
 
     def on_settings_migrate(self, target, current=None):
         self._logger.info("Update version from {} to {}".format(current, target))
@@ -886,12 +1648,37 @@ class IkeaTradfriPlugin(
                 settings_changed = True
 
         self._settings.set(['selected_devices'], selected_devices)
+
+        if current is not None and current < 6:
+            # Runtime state, served by on_settings_load since
+            self._settings.remove(['status'])
+            self._settings.remove(['error_message'])
+            settings_changed = True
+
+        if current is not None and current < 7:
+            # Credentials are kept per gateway since
+            identity = self._settings.get(['identity'])
+            psk = self._settings.get(['psk'])
+            if identity and psk:
+                self._settings.set(['gateway_credentials'], {DEFAULT_GATEWAY: dict(identity=identity, psk=psk)})
+            self._settings.remove(['identity'])
+            self._settings.remove(['psk'])
+            settings_changed = True
+
+        if current is not None and current < 8:
+            # Gateway ids are checked since, those colliding with another gateway were never usable
+            gateways = self._settings.get(['gateways']) or []
+            valid = self.validGateways(gateways)
+            if valid != gateways:
+                self._settings.set(['gateways'], valid)
+                settings_changed = True
+
         if settings_changed:
             self._settings.save()
+        self.registry.rebuild(selected_devices)
 
     def on_event(self, event, payload):
-        devices = self._settings.get(['selected_devices'])
-        for dev in devices:
+        for dev in self.registry.devices:
             schedule_stop = False
             if event == 'PrintDone' and dev['on_done']:
                 schedule_stop = True
@@ -900,12 +1687,7 @@ class IkeaTradfriPlugin(
             if schedule_stop:
                 self.planStop(dev)
             elif event == 'PrintStarted':
-                if dev['id'] in self.stopTimer and self.stopTimer[dev['id']] is not None:
-                    self.stopTimer[dev['id']].cancel()
-                    self.stopTimer[dev['id']] = None
-                if dev['id'] in self.stopCooldown and self.stopCooldown[dev['id']] is not None:
-                    self.stopCooldown[dev['id']].cancel()
-                    self.stopCooldown[dev['id']] = None
+                self.cancelStop(dev['id'])
 
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class GatewayUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    # Opens after `threshold` consecutive gateway failures. While open, requests fail fast instead of each waiting
+    # for its own timeout. After `reset_timeout` seconds a single probe is let through (half open): it closes the
+    # breaker again when the gateway answers, or keeps it open for another `reset_timeout`.
+
+    def __init__(self, threshold=5, reset_timeout=30, on_change=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.stats = dict(opened=0, rejected=0, probes=0)
+        self._on_change = on_change
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        self.stats['rejected'] += 1
+        return False
+
+    def success(self):
+        self.failures = 0
+        self._set(CLOSED)
+
+    def failure(self):
+        # Returns True when this failure opened the breaker
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            self.openedAt = time.time()
+            self.stats['opened'] += 1
+            self._set(OPEN)
+            return True
+        return False
+
+    def probe(self):
+        self.stats['probes'] += 1
+        self._set(HALF_OPEN)
+
+    def info(self):
+        retryAt = None
+        if self.state == OPEN:
+            retryAt = self.openedAt + self.reset_timeout
+        return dict(state=self.state, failures=self.failures, retryAt=retryAt)
+
+    def _set(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        if state == CLOSED:
+            self.openedAt = None
+        if self._on_change is not None:
+            self._on_change(state)
@@ -46,4 +46,71 @@ def commands(cli_group, pass_octoprint_ctx, *args, **kwargs):
         )
         client.post_json('api/plugin/ikea_tradfri', data=data)
 
-    return [turnOn, turnOff]
+    @click.command()
+    @click.argument('name')
+    @client_options
+    def turnOnSet(name, apikey, host, port, httpuser, httppass, https, prefix):
+        click.echo('On: {}'.format(name))
+        client = create_client(settings=cli_group.settings,
+            apikey=apikey,
+            host=host,
+            port=port,
+            httpuser=httpuser,
+            httppass=httppass,
+            https=https,
+            prefix=prefix)
+
+        data = dict(
+            command="turnOnSet",
+            set=name
+        )
+        client.post_json('api/plugin/ikea_tradfri', data=data)
+
+    @click.command()
+    @click.argument('name')
+    @client_options
+    def turnOffSet(name, apikey, host, port, httpuser, httppass, https, prefix):
+        click.echo('off: {}'.format(name))
+        client = create_client(settings=cli_group.settings,
+            apikey=apikey,
+            host=host,
+            port=port,
+            httpuser=httpuser,
+            httppass=httppass,
+            https=https,
+            prefix=prefix)
+
+        data = dict(
+            command="turnOffSet",
+            set=name
+        )
+        client.post_json('api/plugin/ikea_tradfri', data=data)
+
+    @click.command()
+    @click.argument('device_id')
+    @click.option('--on/--off', 'on', default=None)
+    @click.option('--brightness', type=click.FloatRange(0, 100), help='Brightness in %')
+    @click.option('--color-temp', type=int, help='Color temperature in mireds (250 - 454)')
+    @click.option('--transition', type=float, help='Transition time in seconds')
+    @client_options
+    def setLight(device_id, on, brightness, color_temp, transition, apikey, host, port, httpuser, httppass, https,
+                 prefix):
+        click.echo('light: {}'.format(device_id))
+        client = create_client(settings=cli_group.settings,
+            apikey=apikey,
+            host=host,
+            port=port,
+            httpuser=httpuser,
+            httppass=httppass,
+            https=https,
+            prefix=prefix)
+
+        data = dict(
+            command="setLight",
+            id=device_id
+        )
+        values = dict(on=on, brightness=brightness, color_temp=color_temp, transition=transition)
+        data.update((key, value) for key, value in values.items() if value is not None)
+        client.post_json('api/plugin/ikea_tradfri', data=data)
+
+    return [turnOn, turnOff, turnOnSet, turnOffSet, setLight]
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import math
+
+
+class CooldownPredictor(object):
+    # Newton's law of cooling: T(t) = ambient + (T0 - ambient) * exp(-k * t). The latest `size` samples of each
+    # sensor are fitted with a least squares line through ln(T - ambient), which predicts when a threshold is
+    # crossed. Samples close to ambient say little about the decay, the ambient is lowered below them.
+
+    def __init__(self, ambient=20, size=12, min_samples=3):
+        self.ambient = ambient
+        self.size = size
+        self.min_samples = min_samples
+        self.stats = dict(samples=0, fits=0)
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=self.size))
+
+    def reset(self):
+        self._samples.clear()
+
+    def add(self, at, temperatures):
+        # `temperatures` as returned by the printer: sensor -> dict(actual=..., target=...)
+        for sensor, values in temperatures.items():
+            if isinstance(values, dict) and values.get('actual') is not None:
+                self._samples[sensor].append((at, float(values['actual'])))
+                self.stats['samples'] += 1
+
+    def fit(self, sensor):
+        # (ambient, intercept, k) of ln(T - ambient) = intercept - k * t, None without a decay to fit
+        samples = self._samples.get(sensor)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ambient = min(self.ambient, min(temp for at, temp in samples) - 1)
+        origin = samples[0][0]
+        xs = [at - origin for at, temp in samples]
+        ys = [math.log(temp - ambient) for at, temp in samples]
+        mx = sum(xs) / len(xs)
+        my = sum(ys) / len(ys)
+        sxx = sum((x - mx) ** 2 for x in xs)
+        if sxx == 0:
+            return None
+        slope = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+        if slope >= 0:
+            # Still heating or steady
+            return None
+        self.stats['fits'] += 1
+        return ambient, my - slope * (mx + origin), -slope
+
+    def eta(self, sensor, threshold, now):
+        # Predicted time the sensor drops to `threshold`: `now` once below it, None when it can not be predicted
+        samples = self._samples.get(sensor)
+        if samples and samples[-1][1] <= threshold:
+            return now
+        fit = self.fit(sensor)
+        if fit is None:
+            return None
+        ambient, intercept, k = fit
+        if threshold <= ambient:
+            return None
+        return max(now, (intercept - math.log(threshold - ambient)) / k)
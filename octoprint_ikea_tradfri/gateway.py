@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+
+import aiocoap
+import aiocoap.error
+
+from .breaker import CLOSED, CircuitBreaker, GatewayUnavailable
+from .metrics import Metrics
+
+# Requested by the breaker probe: any answer of the gateway, even an error code, proves it is back
+PROBE_PATH = '15011/15012'
+
+
+def device_label(path):
+    # '15001/65536' -> '65536', collections such as '15001' are not bound to a device
+    parts = path.strip('/').split('/')
+    return parts[1] if len(parts) == 2 else ''
+
+
+def is_rejection(error):
+    # Unknown or revoked credentials make the gateway abort the DTLS handshake with a fatal alert, which aiocoap
+    # wraps in a NetworkError; timeouts and unreachable gateways are not rejections.
+    return isinstance(error, aiocoap.error.NetworkError) and type(error.__cause__).__name__ == 'FatalDTLSError'
+
+
+class GatewaySession(object):
+    # One event loop on a dedicated thread and long lived aiocoap contexts reused for every request, so the DTLS
+    # session with the gateway is only negotiated once instead of on each GET/PUT.
+    #
+    # aiocoap only keeps one confirmable exchange per remote in flight (NSTART=1), so concurrent requests are
+    # spread over a small pool of contexts; `size` caps the number of requests in flight to the gateway.
+    #
+    # Concurrent GETs of the same resource share one exchange and, when `result_ttl` is set, its response is
+    # reused for that many seconds.
+    #
+    # Every exchange has a deadline (`timeouts`, per method), failed GETs are retried with a jittered exponential
+    # backoff and the circuit breaker fails requests fast while the gateway is down.
+    #
+    # The sessions of the other gateways run on the loop of the `parent` session, each with its own contexts,
+    # request limit and breaker.
+    scheme = 'coaps'
+    port = 5684
+
+    def __init__(self, logger, size=1, result_ttl=0, metrics=None, breaker=None, timeouts=None, retries=2,
+                 backoff=0.5, parent=None):
+        self._logger = logger
+        self._parent = parent
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.size = size
+        self.result_ttl = result_ttl
+        self.timeouts = dict(get=5, put=10)
+        self.timeouts.update(timeouts or dict())
+        self.retries = retries
+        self.backoff = backoff
+        self._probe = None
+        self.stats = dict(get=0, sent=0, coalesced=0, cached=0)
+        self._pending = dict()
+        self._results = dict()
+        self._loop = None
+        self._thread = None
+        self._contexts = set()
+        self._idle = []
+        self._observer = None
+        self._observer_lock = None
+        self._inflight = 0
+        self._available = None
+        self._credentials = None
+        self._lock = threading.Lock()
+
+    def base_uri(self, gateway_ip):
+        return '{}://{}:{}'.format(self.scheme, gateway_ip, self.port)
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return self._loop
+            if self._parent is not None:
+                self._loop = self._parent.start()
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+                loop.close()
+
+            self._thread = threading.Thread(target=run, name='ikea_tradfri_gateway', daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            return loop
+
+    @property
+    def loop(self):
+        return self.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        future = self.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def deadline(self, method='get'):
+        # Upper bound of a request with all its retries, for the callers waiting on it from another thread
+        retries = self.retries if method == 'get' else 0
+        return (retries + 1) * (2 * self.timeouts[method] + self.backoff * 2 ** retries * 1.5)
+
+    def tune(self, size=None, result_ttl=None, timeouts=None, retries=None):
+        if size is not None:
+            self.size = max(1, int(size))
+        if result_ttl is not None:
+            self.result_ttl = float(result_ttl)
+        if timeouts is not None:
+            self.timeouts.update((method, float(timeout)) for method, timeout in timeouts.items())
+        if retries is not None:
+            self.retries = max(0, int(retries))
+
+    def configure(self, gateway_ip, identity, psk):
+        credentials = (gateway_ip, identity, psk)
+        if credentials == self._credentials:
+            return
+        self._credentials = credentials
+        if not self._contexts:
+            return
+        if self._on_loop():
+            # A request on the loop retries right after new credentials, it must not get an old context
+            asyncio.ensure_future(self._close_contexts(self._detach()))
+        else:
+            self.submit(self.reset())
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def _create_context(self):
+        gateway_ip, identity, psk = self._credentials
+        self._logger.debug('Create gateway context for %s' % gateway_ip)
+        start = time.perf_counter()
+        context = await aiocoap.Context.create_client_context()
+        context.client_credentials.load_from_dict({
+            ('{}/*'.format(self.base_uri(gateway_ip))): {
+                'dtls': {
+                    'psk': psk.encode(),
+                    'client-identity': identity.encode()
+                }
+            }
+        })
+        self._contexts.add(context)
+        self.metrics.observe('context', time.perf_counter() - start)
+        return context
+
+    async def acquire(self):
+        if self._available is None:
+            self._available = asyncio.Condition()
+        async with self._available:
+            await self._available.wait_for(lambda: self._inflight < self.size)
+            self._inflight += 1
+        try:
+            if self._idle:
+                return self._idle.pop()
+            return await self._create_context()
+        except Exception:
+            await self._release_slot()
+            raise
+
+    async def release(self, context, broken=False):
+        if broken or context not in self._contexts:
+            self._contexts.discard(context)
+            await self._shutdown(context)
+        else:
+            self._idle.append(context)
+        await self._release_slot()
+
+    async def _release_slot(self):
+        async with self._available:
+            self._inflight -= 1
+            self._available.notify()
+
+    async def reset(self):
+        await self._close_contexts(self._detach())
+
+    def _detach(self):
+        # Forgets the contexts at once, no request picks one up afterwards. Those currently in use are shut down by
+        # release() once their request is done, the others are returned to be shut down.
+        idle, self._idle = self._idle, []
+        observer, self._observer = self._observer, None
+        if self._probe is not None:
+            # Another gateway or new credentials, give them a fresh chance
+            self._probe.cancel()
+            self._probe = None
+            self.breaker.success()
+        self._contexts.clear()
+        self._results.clear()
+        return idle + ([observer] if observer is not None else [])
+
+    async def _close_contexts(self, contexts):
+        for context in contexts:
+            await self._shutdown(context)
+
+    async def _shutdown(self, context):
+        try:
+            await context.shutdown()
+        except Exception as e:
+            self._logger.debug('Error while closing gateway context: %s' % e)
+
+    async def request(self, code, path, payload=b''):
+        if self._credentials is None:
+            raise aiocoap.error.NoRequestInterface('Gateway session is not configured')
+        if not self.breaker.allow():
+            raise GatewayUnavailable('Gateway unavailable, retry after %s' % self.breaker.info()['retryAt'])
+        try:
+            response = await self._request(code, path, payload)
+        except aiocoap.error.NetworkError as e:
+            self.failed(e)
+            raise
+        self.breaker.success()
+        return response
+
+    def failed(self, error):
+        # A rejection is an answer of the gateway, it is up
+        if is_rejection(error) or not self.breaker.failure() or self._probe is not None:
+            return
+        self._logger.warn('Gateway unreachable, fail requests fast for %s s' % self.breaker.reset_timeout)
+        self._probe = asyncio.ensure_future(self._recover())
+
+    async def _recover(self):
+        while True:
+            await asyncio.sleep(self.breaker.reset_timeout)
+            self.breaker.probe()
+            try:
+                await self._request(aiocoap.Code.GET, PROBE_PATH)
+            except Exception as e:
+                if is_rejection(e):
+                    break
+                self._logger.debug('Gateway still unreachable: %s' % e)
+                self.breaker.failure()
+            else:
+                break
+        self._logger.info('Gateway reachable again')
+        self._probe = None
+        self.breaker.success()
+
+    async def _request(self, code, path, payload=b''):
+        uri = '{}/{}'.format(self.base_uri(self._credentials[0]), path.lstrip('/'))
+        device = device_label(path)
+        timeout = self.timeouts['put' if code == aiocoap.Code.PUT else 'get']
+
+        for attempt in range(2):
+            context = await self.acquire()
+            req = aiocoap.Message(code=code, uri=uri, payload=payload)
+            start = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(context.request(req).response, timeout)
+            except asyncio.TimeoutError:
+                await self.release(context, broken=True)
+                raise aiocoap.error.RequestTimedOut()
+            except aiocoap.error.NetworkError as e:
+                # A broken DTLS session (gateway reboot, expired session, ...) surfaces as a network error:
+                # drop the context and reconnect once with a fresh handshake.
+                self._logger.warn('Gateway session failed (%s), reconnecting' % e)
+                await self.release(context, broken=True)
+                if attempt:
+                    raise
+            except BaseException:
+                await self.release(context)
+                raise
+            else:
+                self.metrics.observe('coap', time.perf_counter() - start, device)
+                await self.release(context)
+                return response
+
+    async def observe(self, path):
+        # Observations stay registered for a long time, so they all share one context outside of the request pool.
+        # Returns the observer context with the pending aiocoap request: await `.response` for the current state and
+        # iterate `.observation` for the notifications.
+        if self._credentials is None:
+            raise aiocoap.error.NoRequestInterface('Gateway session is not configured')
+        if not self.breaker.allow():
+            raise GatewayUnavailable('Gateway unavailable, retry after %s' % self.breaker.info()['retryAt'])
+        if self._observer_lock is None:
+            self._observer_lock = asyncio.Lock()
+        async with self._observer_lock:
+            if self._observer is None:
+                self._observer = await self._create_context()
+            observer = self._observer
+        uri = '{}/{}'.format(self.base_uri(self._credentials[0]), path.lstrip('/'))
+        return observer, observer.request(aiocoap.Message(code=aiocoap.Code.GET, uri=uri, observe=0))
+
+    async def reset_observer(self, observer, error=None):
+        # Several observations fail together when the observer breaks, only the first one replaces it and counts as
+        # a gateway failure. An observer already replaced by reset() (new credentials, close) is not a failure.
+        if observer is None or observer is not self._observer:
+            return
+        self._observer = None
+        self._contexts.discard(observer)
+        await self._shutdown(observer)
+        if isinstance(error, aiocoap.error.NetworkError):
+            self.failed(error)
+
+    async def get(self, path):
+        key = path.strip('/')
+        self.stats['get'] += 1
+
+        if key in self._results:
+            at, response = self._results[key]
+            if self.loop.time() - at < self.result_ttl:
+                self.stats['cached'] += 1
+                return response
+            del self._results[key]
+
+        if key in self._pending:
+            self.stats['coalesced'] += 1
+        else:
+            self.stats['sent'] += 1
+            task = asyncio.ensure_future(self._fetch(path))
+            self._pending[key] = task
+            task.add_done_callback(lambda task: self._settle(key, task))
+        # A cancelled caller must not cancel the exchange the other callers are waiting for
+        return await asyncio.shield(self._pending[key])
+
+    async def _fetch(self, path):
+        # GETs are idempotent, retry them while the breaker lets them through
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.request(aiocoap.Code.GET, path)
+            except aiocoap.error.NetworkError as e:
+                if attempt == self.retries or is_rejection(e) or self.breaker.state != CLOSED:
+                    raise
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                self._logger.debug('GET %s failed (%s), retry in %.2f s' % (path, e, delay))
+                await asyncio.sleep(delay)
+
+    def _settle(self, key, task):
+        # Superseded by a PUT on the same resource while in flight: neither reuse nor cache it
+        if self._pending.get(key) is not task:
+            return
+        del self._pending[key]
+        if self.result_ttl > 0 and not task.cancelled() and task.exception() is None:
+            self._results[key] = (self.loop.time(), task.result())
+
+    async def put(self, path, payload):
+        self._results.pop(path.strip('/'), None)
+        self._pending.pop(path.strip('/'), None)
+        return await self.request(aiocoap.Code.PUT, path, payload)
+
+    def close(self, timeout=5):
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None and self._parent is not None:
+            # Used through the loop of the parent without ever being started, its contexts still live there
+            loop = self._parent._loop
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.reset(), loop).result(timeout=timeout)
+        except Exception as e:
+            self._logger.debug('Error while closing gateway session: %s' % e)
+        if self._parent is None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+        self._available = None
+        self._observer_lock = None
+        self._inflight = 0
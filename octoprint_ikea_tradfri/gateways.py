@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import re
+
+# The gateway configured by gateway_ip / security_code, the others are listed in the `gateways` setting
+DEFAULT_GATEWAY = 'default'
+
+# Ids of the other gateways end up in device keys, MQTT topics and URLs
+_GATEWAY_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def device_key(gateway_id, device_id):
+    # Device and group ids are only unique on their gateway: those of the default gateway are kept as is, the
+    # others are prefixed with the id of their gateway, e.g. 'room2_65536'.
+    if gateway_id in (None, DEFAULT_GATEWAY):
+        return device_id
+    return '{}_{}'.format(gateway_id, device_id)
+
+
+def native_id(key):
+    # Id of a device or group on its gateway, as used in the resource paths
+    if isinstance(key, str):
+        return int(key.rpartition('_')[2])
+    return key
+
+
+def parse_key(value):
+    # Device keys received as text: ids of the default gateway are numbers, the others keep their prefix
+    value = str(value).strip()
+    # Not int() alone, it reads the key '2_65536' of gateway '2' as 265536
+    if value.isdigit():
+        return int(value)
+    # A ValueError without an id after the prefix
+    native_id(value)
+    return value
+
+
+def gateway_id_error(gateway_id, taken=()):
+    # Why `gateway_id` can not name one of the other gateways, None when it can. `taken` holds the ids already used.
+    if not gateway_id:
+        return 'the id is empty'
+    if gateway_id == DEFAULT_GATEWAY:
+        return "the id '%s' is the one of the gateway configured above" % DEFAULT_GATEWAY
+    if not _GATEWAY_ID.match(gateway_id):
+        return "the id '%s' may only contain letters, digits, '-' and '_'" % gateway_id
+    if gateway_id in taken:
+        return "the id '%s' is already used by another gateway" % gateway_id
+    return None
+
+
+class Gateway(object):
+    # A Tradfri gateway with its credentials and session. The credentials are registered on the gateway on first
+    # use and kept until the gateway rejects them; each gateway authenticates on its own.
+
+    def __init__(self, gateway_id, name, ip, security_code, session, max_inflight_requests=None):
+        self.id = gateway_id
+        self.name = name
+        self.ip = ip
+        self.security_code = security_code
+        self.session = session
+        self.max_inflight_requests = max_inflight_requests
+        self.identity = None
+        self.psk = None
+        self.authAt = None
+        self.authenticating = None
+        self.status = 'waiting'
+
+    def configured(self):
+        return self.ip != "" and self.security_code != ""
+
+    def info(self):
+        return dict(self.session.breaker.info(), id=self.id, name=self.name, status=self.status)
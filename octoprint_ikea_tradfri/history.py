@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import contextlib
+import datetime
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .gateways import parse_key
+
+# time, device slot, state, source
+RECORD = struct.Struct('<dHBB')
+
+# What switched a device: `external` is a change the plugin did not make (remote, app, another controller, ...)
+SOURCES = ('external', 'api', 'mqtt', 'timer', 'cooldown', 'compaction')
+
+
+def _split_days(totals, since, until):
+    # Adds the seconds of [since, until) to the local days they fall on
+    while since < until:
+        day = datetime.date.fromtimestamp(since)
+        midnight = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+        part = min(until, midnight)
+        totals[day.isoformat()] += part - since
+        since = part
+
+
+class HistoryLog(object):
+    # Append-only log of the device state transitions and their source, as fixed size records in `history.bin`.
+    # The device keys of the record slots are listed in `history.keys`, one per line.
+    #
+    # Records are buffered and appended by the scheduler `flush_delay` seconds after the first one, recording a
+    # transition never waits on the disk. Queries scan the memory-mapped file, records are in time order so
+    # ranges are found by bisection. Compaction drops the records older than `retention` seconds and keeps the
+    # devices which were on at that point as a record at the cutoff.
+    key = 'history_flush'
+
+    def __init__(self, folder, scheduler, logger, metrics, flush_delay=10, retention=365 * 86400):
+        self.path = os.path.join(folder, 'history.bin')
+        self.keysPath = os.path.join(folder, 'history.keys')
+        self._scheduler = scheduler
+        self._logger = logger
+        self._metrics = metrics
+        self.flush_delay = flush_delay
+        self.retention = retention
+        self.stats = dict(records=0, writes=0, compactions=0, queries=0)
+        self._keys = []
+        self._slots = dict()
+        self._newKeys = []
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._io = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.keysPath):
+            with open(self.keysPath) as f:
+                for line in f:
+                    if line.strip():
+                        self._slots[parse_key(line)] = len(self._keys)
+                        self._keys.append(parse_key(line))
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            if size % RECORD.size:
+                # Cut short by a crash while appending
+                self._logger.warn('Drop the incomplete last record of %s' % self.path)
+                with open(self.path, 'r+b') as f:
+                    f.truncate(size - size % RECORD.size)
+
+    def record(self, device_id, state, source, at=None):
+        with self._lock:
+            slot = self._slots.get(device_id)
+            if slot is None:
+                slot = self._slots[device_id] = len(self._keys)
+                self._keys.append(device_id)
+                self._newKeys.append(device_id)
+            self._buffer += RECORD.pack(time.time() if at is None else at, slot, 1 if state else 0,
+                                        SOURCES.index(source) if source in SOURCES else 0)
+            self.stats['records'] += 1
+            schedule = len(self._buffer) == RECORD.size
+        if schedule:
+            self._scheduler.schedule(self.key, self.flush_delay, self.flush)
+
+    def flush(self):
+        with self._io:
+            with self._lock:
+                data, self._buffer = bytes(self._buffer), bytearray()
+                keys, self._newKeys = self._newKeys, []
+            # Keys first, a record never refers to an unknown slot
+            if keys:
+                with open(self.keysPath, 'a') as f:
+                    f.write(''.join('%s\n' % key for key in keys))
+            if data:
+                with open(self.path, 'ab') as f:
+                    f.write(data)
+                self.stats['writes'] += 1
+        return len(data) // RECORD.size
+
+    @contextlib.contextmanager
+    def _view(self):
+        # Memory-mapped records and their count, empty without any record
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < RECORD.size:
+            yield memoryview(b''), 0
+            return
+        with open(self.path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                yield view, len(view) // RECORD.size
+            finally:
+                view.release()
+                mapped.close()
+
+    def _bisect(self, view, count, at):
+        # Index of the first record at or after `at`
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(view, mid * RECORD.size)[0] < at:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _range(self, view, count, start, end):
+        first = 0 if start is None else self._bisect(view, count, start)
+        last = count if end is None else self._bisect(view, count, end)
+        return first, max(first, last)
+
+    def events(self, start=None, end=None, device_id=None, limit=1000):
+        self.flush()
+        self.stats['queries'] += 1
+        slot = None
+        if device_id is not None:
+            slot = self._slots.get(device_id)
+            if slot is None:
+                return []
+        res = []
+        with self._metrics.timer('history_query'), self._view() as (view, count):
+            first, last = self._range(view, count, start, end)
+            for at, recordSlot, state, source in RECORD.iter_unpack(view[first * RECORD.size:last * RECORD.size]):
+                if slot is not None and recordSlot != slot:
+                    continue
+                res.append(dict(time=at, device=self._keys[recordSlot], state=state == 1, source=SOURCES[source]))
+                if limit and len(res) >= limit:
+                    break
+        return res
+
+    def onTime(self, start, end):
+        # Seconds each device was on per local day within [start, end)
+        self.flush()
+        self.stats['queries'] += 1
+        end = min(end, time.time())
+        totals = collections.defaultdict(lambda: collections.defaultdict(float))
+        with self._metrics.timer('history_query'), self._view() as (view, count):
+            first, last = self._range(view, count, start, end)
+            # State of the devices when the range starts, from the records before it
+            on = dict()
+            for at, slot, state, source in RECORD.iter_unpack(view[:first * RECORD.size]):
+                if state:
+                    on[slot] = start
+                else:
+                    on.pop(slot, None)
+            for at, slot, state, source in RECORD.iter_unpack(view[first * RECORD.size:last * RECORD.size]):
+                if state and slot not in on:
+                    on[slot] = at
+                elif not state and slot in on:
+                    _split_days(totals[slot], on.pop(slot), at)
+            for slot, since in on.items():
+                _split_days(totals[slot], since, end)
+        return dict((self._keys[slot], dict(days)) for slot, days in totals.items())
+
+    def compact(self, now=None):
+        self.flush()
+        cutoff = (time.time() if now is None else now) - self.retention
+        with self._io:
+            with self._view() as (view, count):
+                first = self._bisect(view, count, cutoff)
+                if not first:
+                    return False
+                on = dict()
+                for at, slot, state, source in RECORD.iter_unpack(view[:first * RECORD.size]):
+                    on[slot] = state
+                data = bytearray()
+                for slot, state in sorted(on.items()):
+                    if state:
+                        data += RECORD.pack(cutoff, slot, 1, SOURCES.index('compaction'))
+                data += view[first * RECORD.size:count * RECORD.size]
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        self.stats['compactions'] += 1
+        self._logger.info('History compacted, %d records dropped' % (count - len(data) // RECORD.size))
+        return True
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import concurrent.futures
+import threading
+import time
+import uuid
+
+
+class CommandFailed(Exception):
+    # Raised by a job whose command the gateway did not carry out, the job fails without a traceback in the log
+    pass
+
+
+class JobQueue(object):
+    # Runs device commands in the background. Jobs of one device run one after the other in submission order,
+    # jobs of different devices run in parallel on the worker threads. A job may hold several devices, it keeps its
+    # place in the order of each of them.
+
+    def __init__(self, logger, on_done, max_workers=4, keep=100):
+        self._logger = logger
+        self._on_done = on_done
+        self._keep = keep
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix='ikea_tradfri_job')
+        self._jobs = collections.OrderedDict()
+        self._queues = dict()
+        self._events = dict()
+        self._lock = threading.Lock()
+
+    def submit(self, device_id, command, fn, *args):
+        return self.submit_for([device_id], device_id, command, fn, *args)
+
+    def submit_for(self, keys, device_id, command, fn, *args):
+        # A job holding several keys, e.g. a device set with its member devices: it runs once the jobs submitted
+        # before it on each of these keys are done, and the later ones wait for it.
+        job = dict(id=uuid.uuid4().hex, device_id=device_id, command=command, status='queued',
+                   created=time.time(), started=None, finished=None, error=None)
+        entry = (job, fn, args, tuple(collections.OrderedDict.fromkeys(keys)))
+        with self._lock:
+            self._jobs[job['id']] = job
+            self._events[job['id']] = threading.Event()
+            self._forget()
+            for key in entry[3]:
+                self._queues.setdefault(key, collections.deque()).append(entry)
+            self._start(entry)
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def wait(self, job_id, timeout=None):
+        event = self._events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(job_id)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def _forget(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(0, len(self._jobs) - self._keep)]:
+            del self._jobs[job_id]
+            del self._events[job_id]
+
+    def _start(self, entry):
+        # The running job stays first in its queues until it is done
+        job = entry[0]
+        if job['status'] != 'queued' or any(self._queues[key][0] is not entry for key in entry[3]):
+            return
+        job['status'] = 'running'
+        self._executor.submit(self._run, entry)
+
+    def _run(self, entry):
+        job, fn, args, keys = entry
+        with self._lock:
+            job['started'] = time.time()
+
+        try:
+            fn(*args)
+        except CommandFailed as e:
+            self._logger.warn('Job %s (%s) failed: %s' % (job['id'], job['command'], e))
+            status, error = 'failed', str(e)
+        except Exception as e:
+            self._logger.exception('Job %s (%s) failed' % (job['id'], job['command']))
+            status, error = 'failed', str(e)
+        else:
+            status, error = 'done', None
+
+        with self._lock:
+            job['status'] = status
+            job['error'] = error
+            job['finished'] = time.time()
+            event = self._events.get(job['id'])
+            result = dict(job)
+            for key in keys:
+                queue = self._queues[key]
+                queue.popleft()
+                if len(queue):
+                    self._start(queue[0])
+                else:
+                    del self._queues[key]
+        if event is not None:
+            event.set()
+        try:
+            self._on_done(result)
+        except Exception:
+            self._logger.exception('Failed to report job %s' % job['id'])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+
+# Color temperature range of the Tradfri white spectrum bulbs, in mireds
+COLOR_TEMP_MIN = 250
+COLOR_TEMP_MAX = 454
+
+SETTINGS = ('on', 'brightness', 'color_temp', 'transition')
+
+
+def light_item(values):
+    # Gateway fields of a light update: `on` (bool), `brightness` (0-100 %), `color_temp` (mireds) and `transition`
+    # (seconds). Raises ValueError on anything else.
+    item = dict()
+    for key, value in values.items():
+        if key == 'on':
+            item['5850'] = 1 if value else 0
+        elif key == 'brightness':
+            brightness = float(value)
+            if not 0 <= brightness <= 100:
+                raise ValueError('brightness must be between 0 and 100')
+            item['5851'] = int(round(brightness * 254 / 100))
+        elif key == 'color_temp':
+            item['5711'] = min(COLOR_TEMP_MAX, max(COLOR_TEMP_MIN, int(value)))
+        elif key == 'transition':
+            transition = float(value)
+            if transition < 0:
+                raise ValueError('transition must be positive')
+            item['5712'] = int(round(transition * 10))
+        else:
+            raise ValueError('unknown light setting %s' % key)
+    return item
+
+
+class LightController(object):
+    # Coalesces light updates per device: the settings received until the next flush are merged, the latest value
+    # of each field wins, and a device gets at most `rate` flushes per second. A slider drag ends up as a few
+    # merged PUTs instead of one per move.
+
+    def __init__(self, scheduler, dispatch, rate=5):
+        self._scheduler = scheduler
+        self._dispatch = dispatch
+        self.rate = rate
+        self.stats = dict(updates=0, flushes=0)
+        self._pending = dict()
+        self._sent = dict()
+        self._lock = threading.Lock()
+
+    def update(self, device_id, values):
+        item = light_item(values)
+        key = ('light', device_id)
+        with self._lock:
+            self.stats['updates'] += 1
+            self._pending.setdefault(device_id, dict()).update(item)
+            merged = dict(self._pending[device_id])
+            if not self._scheduler.pending(key):
+                delay = 0
+                if device_id in self._sent and self.rate > 0:
+                    delay = max(0, self._sent[device_id] + 1.0 / self.rate - time.time())
+                self._scheduler.schedule(key, delay, self._dispatch, device_id)
+        return merged
+
+    def take(self, device_id):
+        # Called when the PUT is about to be sent, so updates received while it was queued still make it in
+        with self._lock:
+            item = self._pending.pop(device_id, None)
+            if item is not None:
+                self.stats['flushes'] += 1
+                self._sent[device_id] = time.time()
+            return item
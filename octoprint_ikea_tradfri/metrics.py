@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    # Latency histograms keyed by operation and device. Recording is a bucket lookup and three increments, cheap
+    # enough to stay enabled on the hot paths.
+
+    def __init__(self):
+        self._histograms = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, operation, seconds, device=''):
+        key = (operation, '' if device is None else str(device))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, operation, device=''):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(operation, time.perf_counter() - start, device)
+
+    def snapshot(self):
+        res = dict()
+        with self._lock:
+            for (operation, device), histogram in sorted(self._histograms.items()):
+                buckets = dict()
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                res.setdefault(operation, dict())[device] = dict(count=histogram.count, sum=histogram.sum,
+                                                                 buckets=buckets)
+        return res
+
+    def prometheus(self, counters=None, gauges=None, prefix='octoprint_ikea_tradfri'):
+        lines = [
+            '# HELP {}_duration_seconds Latency of the plugin operations'.format(prefix),
+            '# TYPE {}_duration_seconds histogram'.format(prefix),
+        ]
+        for operation, devices in self.snapshot().items():
+            for device, histogram in devices.items():
+                labels = 'operation="{}",device="{}"'.format(operation, device)
+                for bound, count in histogram['buckets'].items():
+                    lines.append('{}_duration_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, bound, count))
+                lines.append('{}_duration_seconds_sum{{{}}} {}'.format(prefix, labels, histogram['sum']))
+                lines.append('{}_duration_seconds_count{{{}}} {}'.format(prefix, labels, histogram['count']))
+
+        for group, values in sorted((counters or dict()).items()):
+            for name, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append('{}_{}_{}_total {}'.format(prefix, group, name, value))
+        for name, value in sorted((gauges or dict()).items()):
+            lines.append('{}_{} {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
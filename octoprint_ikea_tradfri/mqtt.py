@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import threading
+import time
+
+
+class MessageQueue(object):
+    # Bounded hand-off between the MQTT client thread and the plugin, handled on `workers` threads. Messages with
+    # the same key are coalesced while they wait: the latest one wins, or `merge(old_args, new_args)` combines them.
+    # While `maxsize` keys are waiting, messages with a new key are dropped. A key is handled by one worker at a
+    # time, keys are taken in the order they arrived.
+
+    def __init__(self, logger, metrics, maxsize=100, workers=1):
+        self._logger = logger
+        self._metrics = metrics
+        self.maxsize = maxsize
+        self.workers = workers
+        self.stats = dict(received=0, coalesced=0, dropped=0, handled=0, failed=0)
+        self._pending = collections.OrderedDict()
+        self._active = set()
+        self._threads = []
+        self._running = True
+        self._cond = threading.Condition()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def put(self, key, fn, args=(), merge=None):
+        with self._cond:
+            self.stats['received'] += 1
+            item = self._pending.get(key)
+            if item is not None:
+                self.stats['coalesced'] += 1
+                item[0] = fn
+                item[1] = merge(item[1], args) if merge is not None else args
+                return True
+            if len(self._pending) >= self.maxsize or not self._running:
+                self.stats['dropped'] += 1
+                return False
+            self._pending[key] = [fn, args, time.perf_counter()]
+            if len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='ikea_tradfri_mqtt', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._cond.notify()
+        return True
+
+    def shutdown(self):
+        with self._cond:
+            self._running = False
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def _next(self):
+        for key in self._pending:
+            if key not in self._active:
+                return key
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                key = self._next()
+                while key is None and self._running:
+                    self._cond.wait()
+                    key = self._next()
+                if not self._running:
+                    return
+                fn, args, received = self._pending.pop(key)
+                self._active.add(key)
+
+            try:
+                fn(*args)
+            except Exception:
+                self._logger.exception('Failed to handle MQTT message %s' % (key,))
+                result = 'failed'
+            else:
+                result = 'handled'
+            self._metrics.observe('mqtt', time.perf_counter() - received)
+
+            with self._cond:
+                self.stats[result] += 1
+                self._active.discard(key)
+                # Another message of this key may be waiting for it
+                self._cond.notify_all()
+
+
+class StatePublisher(object):
+    # Device states as retained MQTT messages: `state/<id>` when the state of a device changes and the `states`
+    # snapshot with every device, once per burst of changes. With a `heartbeat` the snapshot is also republished
+    # that often, its `time` tells consumers the plugin is alive.
+    key = 'mqtt_states'
+    heartbeatKey = 'mqtt_heartbeat'
+
+    def __init__(self, publish, scheduler, snapshot, heartbeat=0, delay=0.5):
+        self._publish = publish
+        self._scheduler = scheduler
+        self._snapshot = snapshot
+        self.heartbeat = heartbeat
+        self.delay = delay
+        self.stats = dict(published=0, unchanged=0, snapshots=0)
+        self._last = dict()
+        self._lastSnapshot = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.publishSnapshot(force=True)
+
+    def device(self, device_id, state):
+        with self._lock:
+            if device_id in self._last and self._last[device_id] == state:
+                self.stats['unchanged'] += 1
+                return False
+            self._last[device_id] = state
+            self.stats['published'] += 1
+        self._publish('state/%s' % device_id, dict(state=state), retained=True)
+        if not self._scheduler.pending(self.key):
+            self._scheduler.schedule(self.key, self.delay, self.publishSnapshot)
+        return True
+
+    def publishSnapshot(self, force=False):
+        states = self._snapshot()
+        with self._lock:
+            if not force and states == self._lastSnapshot:
+                return False
+            self._lastSnapshot = states
+            self.stats['snapshots'] += 1
+        self._publish('states', dict(states=states, time=time.time()), retained=True)
+        if self.heartbeat > 0:
+            # Moved by every snapshot, the heartbeat only fires after `heartbeat` quiet seconds
+            self._scheduler.schedule(self.heartbeatKey, self.heartbeat, self.publishSnapshot, True)
+        return True
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+
+class SettingsWriter(object):
+    # Write-behind for the settings the plugin changes itself. A change only marks the settings dirty, they are
+    # written once `delay` seconds after the first change, together with everything changed in between. Setting a
+    # value equal to the current one changes nothing and writes nothing.
+    key = 'settings_save'
+
+    def __init__(self, settings, scheduler, logger, metrics, delay=5):
+        self._settings = settings
+        self._scheduler = scheduler
+        self._logger = logger
+        self._metrics = metrics
+        self.delay = delay
+        self.dirty = False
+        self.stats = dict(changes=0, unchanged=0, writes=0)
+        self._lock = threading.Lock()
+
+    def set(self, path, value):
+        with self._lock:
+            if self._settings.get(path) == value:
+                self.stats['unchanged'] += 1
+                return False
+            self._settings.set(path, value)
+            self.stats['changes'] += 1
+            if not self.dirty:
+                self.dirty = True
+                if self.delay > 0:
+                    self._scheduler.schedule(self.key, self.delay, self.flush)
+        if self.delay <= 0:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self._lock:
+            if not self.dirty:
+                return False
+            self.dirty = False
+            self._scheduler.cancel(self.key)
+            with self._metrics.timer('settings_save'):
+                self._settings.save()
+            self.stats['writes'] += 1
+        self._logger.debug('Settings saved')
+        return True
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import threading
+
+_REMOVED = object()
+
+
+def diff(old, new):
+    # Keys of `new` whose value differs from `old`, nested dicts are compared key by key. Returns _REMOVED when a
+    # key disappeared, as a partial update can not express a removal.
+    changes = dict()
+    for key in old:
+        if key not in new:
+            return _REMOVED
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested = diff(old[key], value)
+            if nested is _REMOVED:
+                return _REMOVED
+            if nested:
+                changes[key] = nested
+        elif old[key] != value:
+            changes[key] = value
+    return changes
+
+
+class PushChannel(object):
+    # Remembers the last payload pushed per message type and only pushes the keys which changed since, or
+    # nothing at all when nothing changed.
+
+    def __init__(self, send):
+        self._send = send
+        self._last = dict()
+        self._lock = threading.Lock()
+        self.stats = dict(sent=0, partial=0, suppressed=0)
+
+    def push(self, msg_type, payload):
+        with self._lock:
+            payload = copy.deepcopy(payload)
+            last = self._last.get(msg_type)
+            changes = _REMOVED if last is None else diff(last, payload)
+            if changes is not _REMOVED and not changes:
+                self.stats['suppressed'] += 1
+                return False
+            self._last[msg_type] = payload
+            self.stats['sent'] += 1
+
+            # Sent under the lock: partial updates must reach the clients in the order they were computed
+            if changes is _REMOVED:
+                self._send(msg_type, payload, partial=False)
+            else:
+                self.stats['partial'] += 1
+                self._send(msg_type, changes, partial=True)
+        return True
+
+    def reset(self, msg_type=None):
+        with self._lock:
+            if msg_type is None:
+                self._last.clear()
+            else:
+                self._last.pop(msg_type, None)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from .gateways import DEFAULT_GATEWAY, native_id
+from .state import device_code, read_state
+
+
+class DeviceRecord(object):
+    # What a command on a selected device needs, computed once: its settings, gateway, resource path and PUT
+    # payloads
+    __slots__ = ('id', 'device', 'gateway', 'code', 'path', 'payloads')
+
+    def __init__(self, device):
+        self.id = device['id']
+        self.device = device
+        self.gateway = device.get('gateway') or DEFAULT_GATEWAY
+        self.code = device_code(device)
+        self.path = '15001/{}'.format(native_id(self.id))
+        self.payloads = (json.dumps({self.code: [{"5850": 0}]}, separators=(',', ':')).encode(),
+                         json.dumps({self.code: [{"5850": 1}]}, separators=(',', ':')).encode())
+
+    def decode_state(self, payload):
+        return read_state(self.code, payload)
+
+
+class DeviceRegistry(object):
+    # Index of the selected devices by id, rebuilt whenever they are saved. Lookups do not touch the settings, which
+    # deep-copy the whole list on every read.
+
+    def __init__(self):
+        self.devices = []
+        self._records = dict()
+
+    def rebuild(self, selected_devices):
+        records = dict()
+        for device in selected_devices:
+            if device.get('id') is not None:
+                records[device['id']] = DeviceRecord(device)
+        # Swapped in once built, readers on other threads never see a partial index
+        self.devices, self._records = selected_devices, records
+
+    def get(self, device_id):
+        return self._records.get(device_id)
+
+    def device(self, device_id):
+        record = self._records.get(device_id)
+        return None if record is None else record.device
+
+    def records(self):
+        return self._records.values()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler(object):
+    # One thread owning every deadline of the plugin (shutdown timers, cooldown checks, printer connection).
+    # Deadlines are kept in a heap keyed by an arbitrary hashable key; cancelling or moving a deadline only marks
+    # the old heap entry as stale, so every operation stays O(log n). Callbacks run on the scheduler thread and
+    # must hand anything slow over to another thread.
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._heap = []
+        self._entries = dict()
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='ikea_tradfri_scheduler', daemon=True)
+            self._thread.start()
+
+    def shutdown(self, timeout=5):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._running = False
+            self._condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+
+    def schedule(self, key, delay, fn, *args):
+        return self.schedule_at(key, time.time() + delay, fn, *args)
+
+    def schedule_at(self, key, deadline, fn, *args):
+        self.start()
+        with self._condition:
+            entry = [deadline, next(self._counter), key, fn, args]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+        return deadline
+
+    def postpone(self, key, delay):
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return self.schedule_at(key, entry[0] + delay, entry[3], *entry[4])
+
+    def postpone_or_schedule(self, key, delay, fn, *args):
+        # Moves a pending deadline by `delay` or schedules a new one in `delay` seconds, returns the deadline. One
+        # step: a deadline firing meanwhile can not leave the caller without one.
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is None:
+                return self.schedule(key, delay, fn, *args)
+            return self.schedule_at(key, entry[0] + delay, entry[3], *entry[4])
+
+    def cancel(self, key):
+        with self._condition:
+            return self._entries.pop(key, None) is not None
+
+    def pending(self, key):
+        return key in self._entries
+
+    def deadline(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running:
+                    # Drop the heap entries which were cancelled or replaced since they were pushed
+                    while self._heap and self._entries.get(self._heap[0][2]) is not self._heap[0]:
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= time.time():
+                        entry = heapq.heappop(self._heap)
+                        del self._entries[entry[2]]
+                        break
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                else:
+                    return
+
+            try:
+                entry[3](*entry[4])
+            except Exception:
+                self._logger.exception('Scheduled task %s failed' % (entry[2],))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncio
+import json
+import re
+import threading
+import time
+
+import aiocoap.error
+
+from .gateway import is_rejection
+
+
+def device_code(device):
+    if device is not None and 'type' in device and device['type'] is not None and device['type'] != "Outlet":
+        return "3311"  # Light
+    return "3312"
+
+
+# First item of the light (3311) or outlet (3312) list; the gateway sends it as a flat object
+_KEYS = dict((code, b'"' + code.encode() + b'"') for code in ("3311", "3312"))
+_ITEM = re.compile(br'"\d+"\s*:\s*\[\s*\{([^{}\[\]]*)\}')
+_FIELDS = re.compile(br'"(5850|5851)"\s*:\s*(\d+)')
+
+
+def extract_state(code, data):
+    if code in data and len(data[code]) > 0 and "5850" in data[code][0]:
+        return data[code][0]["5850"] == 1
+    return False
+
+
+def read_fields(code, payload):
+    # On/off (5850) and dimmer (5851) of a device, read from the raw payload without decoding the whole document.
+    # Falls back to the JSON decoder for anything the fast path does not recognise.
+    index = payload.find(_KEYS[code])
+    match = _ITEM.match(payload, index) if index >= 0 else None
+    if match is not None:
+        fields = dict(_FIELDS.findall(match.group(1)))
+        if b'5850' in fields:
+            dimmer = fields.get(b'5851')
+            return fields[b'5850'] == b'1', None if dimmer is None else int(dimmer)
+    data = json.loads(payload)
+    item = data[code][0] if code in data and len(data[code]) > 0 else dict()
+    return extract_state(code, data), item.get("5851")
+
+
+def read_state(code, payload):
+    return read_fields(code, payload)[0]
+
+
+def decode_state(code, response):
+    if not response.code.is_successful():
+        raise aiocoap.error.ResponseWrappingError(response)
+    return read_state(code, response.payload)
+
+
+class StateEngine(object):
+    # In-memory state table of the selected devices, kept up to date with CoAP observe (or by polling the
+    # devices which can not be observed) on the gateway session loop. Reads never touch the gateway.
+    #
+    # Each device is followed through the session of its gateway, `sessions` maps a gateway id to it. `connect` and
+    # `on_rejected` get the gateway id as well.
+
+    def __init__(self, session, logger, connect, on_change, poll_interval=30, on_rejected=None, sessions=None):
+        self._session = session
+        self._sessions = sessions if sessions is not None else (lambda gateway: session)
+        self._logger = logger
+        self._connect = connect
+        self._on_change = on_change
+        self._on_rejected = on_rejected
+        self.poll_interval = poll_interval
+        self._states = dict()
+        self._updated = dict()
+        self._tasks = dict()
+        self._lock = threading.Lock()
+
+    def get(self, device_id):
+        return self._states.get(device_id)
+
+    def age(self, device_id):
+        updated = self._updated.get(device_id)
+        return None if updated is None else time.time() - updated
+
+    def snapshot(self):
+        return dict((device_id, dict(state=state)) for device_id, state in self._states.items())
+
+    def restore(self, states):
+        # Last known states, served until the gateway answered. They have no age as they may be outdated.
+        with self._lock:
+            for device_id, state in states.items():
+                if device_id not in self._states:
+                    self._states[device_id] = state
+
+    def set(self, device_id, state):
+        with self._lock:
+            changed = device_id not in self._states or self._states[device_id] != state
+            self._states[device_id] = state
+            self._updated[device_id] = time.time()
+        if changed:
+            self._on_change(device_id, state)
+        return changed
+
+    def watch(self, records):
+        # DeviceRecord-like items: id, gateway, code and path
+        wanted = dict((record.id, (record.gateway, record.code, record.path)) for record in records)
+        return self._session.submit(self._watch(wanted))
+
+    def stop(self, timeout=5):
+        if self._tasks:
+            self._session.run(self._watch(dict()), timeout=timeout)
+
+    async def _watch(self, wanted):
+        cancelled = []
+        for device_id, (target, task) in list(self._tasks.items()):
+            if wanted.get(device_id) != target:
+                task.cancel()
+                cancelled.append(task)
+                del self._tasks[device_id]
+                with self._lock:
+                    self._states.pop(device_id, None)
+                    self._updated.pop(device_id, None)
+        if cancelled:
+            await asyncio.gather(*cancelled, return_exceptions=True)
+        for device_id, target in wanted.items():
+            if device_id not in self._tasks:
+                self._tasks[device_id] = (target, asyncio.ensure_future(self._follow(device_id, *target)))
+
+    async def _follow(self, device_id, gateway, code, path):
+        while True:
+            observer = None
+            session = None
+            try:
+                if not await self._connect(gateway):
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                session = self._sessions(gateway)
+                observer, request = await session.observe(path)
+                try:
+                    response = await request.response
+                    self._update(device_id, code, response)
+                    if response.opt.observe is None:
+                        self._logger.info('Device %s can not be observed, poll it every %s s'
+                                          % (device_id, self.poll_interval))
+                        await self._poll(session, device_id, code, path)
+                    async for response in request.observation:
+                        self._update(device_id, code, response)
+                finally:
+                    if not request.observation.cancelled:
+                        request.observation.cancel()
+                # The gateway ended the observation, register again
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except (aiocoap.error.NetworkError, aiocoap.error.LibraryShutdown) as e:
+                self._logger.warn('Observation of device %s failed: %s' % (device_id, e))
+                if observer is not None:
+                    await session.reset_observer(observer, e)
+                elif session is not None and isinstance(e, aiocoap.error.NetworkError):
+                    # No observer yet, this attempt of the device failed on its own
+                    session.failed(e)
+                if self._on_rejected is not None and is_rejection(e):
+                    await self._on_rejected(gateway)
+                await asyncio.sleep(1)
+            except Exception as e:
+                self._logger.warn('Failed to follow state of device %s: %s' % (device_id, e))
+                await asyncio.sleep(self.poll_interval)
+
+    def _update(self, device_id, code, response):
+        with self._session.metrics.timer('decode', device_id):
+            state = decode_state(code, response)
+        self.set(device_id, state)
+
+    async def _poll(self, session, device_id, code, path):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            response = await session.get(path)
+            self._update(device_id, code, response)
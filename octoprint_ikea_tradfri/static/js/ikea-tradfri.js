@@ -20,7 +20,9 @@ $(function () {
 
         self.sidebarInfo = ko.observable({
             shutdownAt: {},
-            cooldown_wait: {}
+            cooldown_wait: {},
+            cooldownAt: {},
+            gateways: {}
         });
 
         self.navInfo = ko.observable({
@@ -112,21 +114,44 @@ $(function () {
 
         self.onDataUpdaterPluginMessage = function (plugin, msg) {
             if (plugin == 'ikea_tradfri') {
+                // Partial messages only carry the keys which changed since the previous message
                 if (msg.type == 'sidebar') {
-                    self.onSidebarInfo(msg.payload);
+                    self.onSidebarInfo(msg.partial ? $.extend(true, {}, self.sidebarInfo(), msg.payload) : msg.payload);
                 } else if (msg.type == 'navbar') {
-                    self.navInfo(msg.payload);
+                    self.navInfo(msg.partial ? $.extend(true, {}, self.navInfo(), msg.payload) : msg.payload);
+                } else if (msg.type == 'startup' && msg.payload.step == 'done') {
+                    // Until then the navbar showed the states of the previous run
+                    self.getNavbarInfo();
                 }
             }
         }
 
         self.onStartupComplete = function (event) {
             self.getSideBarInfo();
-            self.getNavbarInfo();
-            setInterval(self.getNavbarInfo, 60 * 1000);
-
+            self.pollStates();
         }
 
+        // Long-poll of the plugin's state cache, answered as soon as a state changed
+        self.stateVersion = null;
+        self.pollStates = function () {
+            $.ajax({
+                url: BASEURL + "plugin/ikea_tradfri/states/stream",
+                type: "GET",
+                dataType: "json",
+                data: self.stateVersion == null ? {} : {since: self.stateVersion, timeout: 25}
+            }).done(function (data) {
+                self.stateVersion = data.version;
+                if (data.full) {
+                    self.navInfo({state: data.state});
+                } else if (!$.isEmptyObject(data.state)) {
+                    self.navInfo($.extend(true, {}, self.navInfo(), {state: data.state}));
+                }
+                setTimeout(self.pollStates, (data.retry || 0) * 1000);
+            }).fail(function () {
+                setTimeout(self.pollStates, 10 * 1000);
+            });
+        };
+
         self.getSideBarInfo = function(){
             $.ajax({
                 url: BASEURL + "plugin/ikea_tradfri/sidebar/info",
@@ -157,6 +182,18 @@ $(function () {
             return self.sidebarInfo() && self.sidebarInfo().shutdownAt[dev.id()] != null
         }
 
+        self.sidebarCooldownAt = function (dev) {
+            var at = self.sidebarInfo().cooldownAt && self.sidebarInfo().cooldownAt[dev.id()];
+            return at ? new Date(at * 1000).toLocaleTimeString() : null;
+        }
+
+        self.sidebarGateways = function () {
+            var gateways = self.sidebarInfo().gateways || {};
+            return Object.keys(gateways).map(function (id) {
+                return gateways[id];
+            });
+        }
+
         self.sidebarInfoCooldownPlanned = function(dev){
             return self.sidebarInfo() && self.sidebarInfo().cooldown_wait[dev.id()] != null
         }
@@ -221,9 +258,9 @@ $(function () {
             return true;
         };
 
-        self.getDevices = function () {
+        self.getDevices = function (refresh) {
             $.ajax({
-                url: BASEURL + "plugin/ikea_tradfri/devices",
+                url: BASEURL + "plugin/ikea_tradfri/devices" + (refresh ? "?refresh=1" : ""),
                 type: "GET",
                 dataType: "json",
                 contentType: "application/json; charset=UTF-8"
@@ -235,6 +272,23 @@ $(function () {
             });
         }
 
+        self.deviceLabel = function (dev) {
+            return dev.gateway && dev.gateway != 'default' ? dev.name + ' (' + dev.gateway + ')' : dev.name;
+        };
+
+        self.addGateway = function () {
+            self.settings.settings.plugins.ikea_tradfri.gateways.push({
+                id: ko.observable(''),
+                name: ko.observable(''),
+                gateway_ip: ko.observable(''),
+                security_code: ko.observable('')
+            });
+        };
+
+        self.removeGateway = function (gateway) {
+            self.settings.settings.plugins.ikea_tradfri.gateways.remove(gateway);
+        };
+
         let currentDevice = null;
 
         self.showDeviceDialogEdit = function (device) {
@@ -269,7 +323,7 @@ $(function () {
         self.showDeviceDialogNew = function (device) {
             currentDevice = null;
 
-            self.getDevices();
+            self.getDevices(true);
 
             let dialog = $('#ikea_tradfri_device_modal');
             dialog.find('[name="device_name"]').val('Unnamed printer');
@@ -300,7 +354,8 @@ $(function () {
             let dialog = $('#ikea_tradfri_device_modal');
             let device = {
                 name: dialog.find('[name="device_name"]').val(),
-                id: parseInt(dialog.find('[name="device_id"]').val()),
+                // Ids of the devices of the other gateways are prefixed, they are not numbers
+                id: self.deviceIdEdit(),
                 on_done: dialog.find('[name="on_done"]').prop('checked'),
                 on_failed: dialog.find('[name="on_failed"]').prop('checked'),
                 stop_timer: parseInt(dialog.find('[name="stop_timer"]').val()),
@@ -313,6 +368,8 @@ $(function () {
                 cooldown_bed: dialog.find('[name="cooldown_bed"]').val(),
                 cooldown_hotend: dialog.find('[name="cooldown_hotend"]').val()
             };
+            let ikeaDevice = self.devices().find((dev) => dev.id == device.id);
+            device.gateway = ikeaDevice && ikeaDevice.gateway || 'default';
             let connect_palette2 = dialog.find('[name="connect_palette2"]');
             if (connect_palette2) {
                 device.connect_palette2 = connect_palette2.prop('checked');
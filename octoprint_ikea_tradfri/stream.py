@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import threading
+
+
+class StateStream(object):
+    # Versioned copy of the navbar states for long-polling clients. Every changed device bumps the version, a client
+    # passes the last version it saw and gets the devices changed since, or waits until there are some. Clients
+    # never reach the gateway, however many of them are waiting.
+
+    def __init__(self, history=256):
+        self.version = 0
+        self.waiting = 0
+        self.stats = dict(polls=0, timeouts=0, full=0)
+        self._states = dict()
+        # (version, device id) of the latest changes, older clients get the full states
+        self._changes = collections.deque(maxlen=history)
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def update(self, states):
+        with self._cond:
+            removed = [device_id for device_id in self._states if device_id not in states]
+            changed = [device_id for device_id, state in states.items() if self._states.get(device_id) != state]
+            if not removed and not changed:
+                return False
+            if removed:
+                # Not expressible as a change, every client behind starts over from the full states
+                self.version += 1
+                self._changes.clear()
+            else:
+                for device_id in changed:
+                    self.version += 1
+                    self._changes.append((self.version, device_id))
+            self._states = dict(states)
+            self._cond.notify_all()
+        return True
+
+    def changes(self, since=None):
+        with self._cond:
+            return self._changes_since(since)
+
+    def wait(self, since=None, timeout=0):
+        with self._cond:
+            self.stats['polls'] += 1
+            if since == self.version and timeout > 0 and not self._closed:
+                self.waiting += 1
+                try:
+                    if not self._cond.wait_for(lambda: since != self.version or self._closed, timeout):
+                        self.stats['timeouts'] += 1
+                finally:
+                    self.waiting -= 1
+            return self._changes_since(since)
+
+    def close(self):
+        # Releases the waiting clients on shutdown
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _changes_since(self, since):
+        if since == self.version:
+            return dict(version=self.version, full=False, state=dict())
+        oldest = self._changes[0][0] if self._changes else self.version + 1
+        if since is None or since > self.version or since < oldest - 1:
+            self.stats['full'] += 1
+            return dict(version=self.version, full=True, state=dict(self._states))
+        state = dict()
+        for version, device_id in self._changes:
+            if version > since:
+                state[device_id] = self._states[device_id]
+        return dict(version=self.version, full=False, state=state)